@@ -13,16 +13,28 @@ from typing import Optional
 
 import charms.operator_libs_linux.v0.apt as apt
 from charms.operator_libs_linux.v0.apt import PackageError, PackageNotFoundError
-from ops.charm import CharmBase
+from ops.charm import CharmBase, RelationBrokenEvent
 from ops.framework import StoredState
 from ops.interface_kube_control import KubeControlRequirer
 from ops.main import main
-from ops.manifests import Collector, ManifestClientError
+from ops.manifests import Collector, ConfigRegistry, ManifestClientError
+from ops.manifests.literals import APP_LABEL, MANIFEST_LABEL
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 
 from config import CharmConfig
-from kubevirt_manifests import KubeVirtOperator
+from kubevirt_host import parse_hugepages, parse_ksm, tune_kvm, tune_memory
+from kubevirt_manifests import KubeVirtOperator, fingerprint
+from kubevirt_migrations import (
+    DEFAULT_PER_CLUSTER,
+    DEFAULT_PER_NODE,
+    NOT_STARTED,
+    TIMED_OUT,
+    Migrator,
+    plan_rebalance,
+)
 from kubevirt_peer import KubeVirtPeer
+from kubevirt_prepull import PrePuller, launcher_image
+from kubevirt_teardown import Teardown
 
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
@@ -76,7 +88,13 @@ class CharmKubeVirtCharm(CharmBase):
             installed=False,  # True if the binaries have been installed
             deployed=False,  # True if the config has been applied after new hash
             has_kvm=False,  # True if this unit has /dev/kvm
+            kvm_reload_pending=False,  # True if kvm module options await a reload
+            reconciled=None,  # fingerprint of the inputs of the last completed reconcile
+            reconciles_executed=0,  # reconciles which ran the full evaluation
+            reconciles_skipped=0,  # reconciles skipped as their inputs were unchanged
         )
+        # fingerprint of the reconcile attempted during this hook
+        self._attempted: Optional[str] = None
         self.collector = Collector(self.kube_operator)
         self.framework.observe(
             self.on.kube_control_relation_created, self._kube_control
@@ -85,7 +103,7 @@ class CharmKubeVirtCharm(CharmBase):
         self.framework.observe(
             self.on.kube_control_relation_changed, self._kube_control
         )
-        self.framework.observe(self.on.kube_control_relation_broken, self._merge_config)
+        self.framework.observe(self.on.kube_control_relation_broken, self._reconfigure)
 
         self.framework.observe(self.on.kubevirts_relation_created, self._kube_virt)
         self.framework.observe(self.on.kubevirts_relation_joined, self._kube_virt)
@@ -96,11 +114,16 @@ class CharmKubeVirtCharm(CharmBase):
         self.framework.observe(self.on.list_resources_action, self._list_resources)
         self.framework.observe(self.on.scrub_resources_action, self._scrub_resources)
         self.framework.observe(self.on.sync_resources_action, self._sync_resources)
+        self.framework.observe(self.on.plan_upgrade_action, self._plan_upgrade)
+        self.framework.observe(self.on.check_drift_action, self._check_drift)
+        self.framework.observe(self.on.drain_node_action, self._drain_node)
+        self.framework.observe(self.on.rebalance_action, self._rebalance)
+        self.framework.observe(self.on.reconcile_stats_action, self._reconcile_stats)
         self.framework.observe(self.on.update_status, self._update_status)
 
         self.framework.observe(self.on.install, self._install_or_upgrade)
         self.framework.observe(self.on.upgrade_charm, self._install_or_upgrade)
-        self.framework.observe(self.on.config_changed, self._merge_config)
+        self.framework.observe(self.on.config_changed, self._reconfigure)
         self.framework.observe(self.on.stop, self._cleanup)
 
     def _ops_wait_for(self, event, msg: str, exc_info=None) -> str:
@@ -122,25 +145,163 @@ class CharmKubeVirtCharm(CharmBase):
     def _list_resources(self, event):
         manifests = event.params.get("manifest", "")
         resources = event.params.get("resources", "")
-        self.collector.list_resources(event, manifests, resources)
+        with self.kube_operator.selected_kinds(resources.split()):
+            self.collector.list_resources(event, manifests, resources)
+        event.set_results(
+            {
+                f"control-plane-{k}": v
+                for k, v in self.kube_operator.control_plane.items()
+            }
+        )
 
     def _scrub_resources(self, event):
         manifests = event.params.get("manifest", "")
         resources = event.params.get("resources", "")
-        return self.collector.scrub_resources(event, manifests, resources)
+        with self.kube_operator.selected_kinds(resources.split()):
+            return self.collector.scrub_resources(event, manifests, resources)
 
     def _sync_resources(self, event):
         manifests = event.params.get("manifest", "")
         resources = event.params.get("resources", "")
         try:
-            self.collector.apply_missing_resources(event, manifests, resources)
+            with self.kube_operator.selected_kinds(resources.split()):
+                self.collector.apply_missing_resources(event, manifests, resources)
         except ManifestClientError:
             msg = "Failed to apply missing resources. API Server unavailable."
             event.set_results({"result": msg})
         else:
             self.stored.deployed = True
 
+    def _plan_upgrade(self, event):
+        target = event.params["release"]
+        if target not in self.kube_operator.releases:
+            event.fail(f"Unsupported release {target}, see the list-versions action")
+            return
+        plan = self.kube_operator.plan_upgrade(target)
+        limit = 10
+
+        def summarise(fields):
+            more = f", ... ({len(fields) - limit} more)" if len(fields) > limit else ""
+            return ", ".join(fields[:limit]) + more
+
+        results = {
+            "current": plan.current,
+            "target": plan.target,
+            "added": "\n".join(plan.added),
+            "removed": "\n".join(plan.removed),
+            "changed": "\n".join(
+                f"{rsc}: {summarise(fields)}" for rsc, fields in plan.changed.items()
+            ),
+            "summary": f"{len(plan.added)} added, {len(plan.removed)} removed, "
+            f"{len(plan.changed)} changed, {plan.unchanged} unchanged",
+        }
+        event.set_results({k: v for k, v in results.items() if v})
+
+    def _check_drift(self, event):
+        resources = event.params.get("resources", "")
+        try:
+            with self.kube_operator.selected_kinds(resources.split()):
+                drifted = self.kube_operator.drift()
+                if drifted and event.params.get("repair"):
+                    event.log(f"Repairing {', '.join(str(_) for _ in drifted)}")
+                    self.kube_operator.apply_resources(*drifted)
+        except ManifestClientError:
+            event.fail("Failed to check drift. API Server unavailable.")
+            return
+        results = {
+            "drifted": "\n".join(
+                f"{rsc}: {', '.join(fields)}"
+                for rsc, fields in sorted(drifted.items(), key=lambda i: str(i[0]))
+            ),
+            "summary": f"{len(drifted)} drifted resources"
+            + (" repaired" if drifted and event.params.get("repair") else ""),
+        }
+        event.set_results({k: v for k, v in results.items() if v})
+
+    def _migrator(self, label: str) -> Migrator:
+        return Migrator(
+            self.kube_operator.client,
+            per_cluster=int(
+                self.config.get("migration-parallel-per-cluster") or DEFAULT_PER_CLUSTER
+            ),
+            per_node=int(
+                self.config.get("migration-parallel-outbound-per-node")
+                or DEFAULT_PER_NODE
+            ),
+            label=label,
+        )
+
+    def _drain_node(self, event):
+        nodes = event.params["nodes"].split()
+        migrator = self._migrator("drain")
+
+        def progress(result):
+            event.log(f"{result.vmi}: {result.phase} in {result.duration:.1f}s")
+
+        try:
+            if event.params.get("cordon", True):
+                migrator.cordon(nodes)
+            migratable, pinned = migrator.vmis_on(nodes)
+            event.log(f"Migrating {len(migratable)} VMIs off {', '.join(nodes)}")
+            results = migrator.migrate(
+                migratable, progress, event.params.get("timeout") or None
+            )
+        except ManifestClientError:
+            event.fail("Failed to drain nodes. API Server unavailable.")
+            return
+        timed_out = [r for r in results if r.phase in (TIMED_OUT, NOT_STARTED)]
+        failed = [r for r in results if r.phase == "Failed"]
+        migrated = len(results) - len(failed) - len(timed_out)
+        summary = [f"{migrated} migrated", f"{len(failed)} failed"]
+        if timed_out:
+            summary.append(f"{len(timed_out)} timed out")
+        summary.append(f"{len(pinned)} not migratable")
+        results_ = {
+            "migrations": "\n".join(
+                f"{r.vmi} from {r.vmi.node}: {r.phase} in {r.duration:.1f}s"
+                for r in results
+            ),
+            "not-migratable": "\n".join(str(vmi) for vmi in pinned),
+            "timed-out": "\n".join(str(r.vmi) for r in timed_out),
+            "summary": ", ".join(summary),
+        }
+        event.set_results({k: v for k, v in results_.items() if v})
+        if failed:
+            event.fail(f"{len(failed)} migrations failed")
+        elif timed_out:
+            event.fail(f"{len(timed_out)} migrations timed out")
+
+    def _rebalance(self, event):
+        migrator = self._migrator("rebalance")
+        try:
+            capacity, vmis = migrator.snapshot()
+            plan = plan_rebalance(capacity, vmis, event.params["max-migrations"])
+            results = {
+                "plan": "\n".join(f"{m.vmi}: {m.vmi.node} -> {m.target}" for m in plan),
+                "summary": f"{len(plan)} migrations planned across {len(capacity)} nodes",
+            }
+            if plan and not event.params.get("dry-run"):
+                migrated = migrator.migrate(
+                    (m.vmi for m in plan),
+                    timeout=event.params.get("timeout") or None,
+                )
+                failed = [r for r in migrated if r.phase == "Failed"]
+                timed_out = [r for r in migrated if r.phase in (TIMED_OUT, NOT_STARTED)]
+                results["migrations"] = "\n".join(
+                    f"{r.vmi}: {r.phase} in {r.duration:.1f}s" for r in migrated
+                )
+                results["timed-out"] = "\n".join(str(r.vmi) for r in timed_out)
+                results["summary"] += f", {len(failed)} failed"
+                if timed_out:
+                    results["summary"] += f", {len(timed_out)} timed out"
+        except ManifestClientError:
+            event.fail("Failed to rebalance. API Server unavailable.")
+            return
+        event.set_results({k: v for k, v in results.items() if v})
+
     def _update_status(self, _):
+        if self.stored.kvm_reload_pending:
+            self._tune_host()
         if not self.stored.deployed or not self.stored.installed:
             return
 
@@ -171,6 +332,18 @@ class CharmKubeVirtCharm(CharmBase):
         )
 
         status_type = WaitingStatus if "Deployed" not in phases else ActiveStatus
+        if self.unit.is_leader() and self.config["check-drift-on-update-status"]:
+            try:
+                drifted = self.kube_operator.drift()
+            except ManifestClientError:
+                logger.exception("Cannot check for drifted resources")
+            else:
+                if drifted:
+                    phases += f", {len(drifted)} resources drifted (see check-drift)"
+        if self.stored.kvm_reload_pending:
+            phases += ", kvm module reload pending until VMs stop"
+        if self.stored.has_kvm is True and (free := self.kube_virt.free_hugepages()):
+            phases += f", hugepages free: {free}"
         self.unit.status = status_type(phases)
         if self.unit.is_leader():
             self.unit.set_workload_version(self.collector.short_version)
@@ -178,10 +351,19 @@ class CharmKubeVirtCharm(CharmBase):
 
     def _kube_control(self, event):
         self.kube_control.set_auth_request(self.unit.name)
+        self.kube_operator.invalidate()
         return self._merge_config(event)
 
     def _kube_virt(self, event):
-        self.kube_virt.discover()
+        self.kube_virt.discover(self.stored.kvm_reload_pending)
+        self.kube_virt.publish_summary()
+        self.kube_operator.invalidate()
+        return self._merge_config(event)
+
+    def _reconfigure(self, event):
+        if self.stored.installed and not self.charm_config.evaluate():
+            self._tune_host()
+        self.kube_operator.invalidate()
         return self._merge_config(event)
 
     def _check_kube_virts(self, event):
@@ -223,15 +405,52 @@ class CharmKubeVirtCharm(CharmBase):
             return False
         return True
 
-    def _merge_config(self, event):
-        if not self._check_kube_control(event):
-            return
+    def _reconcile_fingerprint(self) -> str:
+        """Fingerprint of every input deciding the outcome of a reconcile."""
+        return fingerprint(
+            [controller.hash() for controller in self.collector.manifests.values()],
+            {
+                name: sorted(r.id for r in self.model.relations[name])
+                for name in ("kube-control", "kubevirts")
+            },
+            self.unit.is_leader(),
+            self.stored.installed,
+        )
+
+    def _skip_reconcile(self, event, inputs: str) -> bool:
+        """Whether a reconcile of these inputs is already done or pending.
+
+        Within a hook, repeated events collapse into the first reconcile, so
+        if it deferred that event remains the single pending reconcile.
+        Across hooks, a completed reconcile is only repeated once its
+        inputs change.
+        """
+        if isinstance(event, RelationBrokenEvent):
+            return False
+        return inputs == self._attempted or inputs == self.stored.reconciled
 
-        if not self._check_kube_virts(event):
+    def _merge_config(self, event):
+        status = self.unit.status
+        ready = (
+            self._check_kube_control(event)
+            and self._check_kube_virts(event)
+            and self._check_config()
+        )
+        if not ready:
+            self._attempted = None
+            self.stored.reconciled = None
             return
 
-        if not self._check_config():
+        inputs = self._reconcile_fingerprint()
+        if self._skip_reconcile(event, inputs):
+            self.stored.reconciles_skipped += 1
+            logger.info("Skipping reconcile, its inputs are unchanged.")
+            # cluster state and drift are left to update-status
+            self.unit.status = status
             return
+        self._attempted = inputs
+        self.stored.reconciled = None
+        self.stored.reconciles_executed += 1
 
         self.unit.status = MaintenanceStatus("Evaluating Manifests")
         new_hash = 0
@@ -242,12 +461,30 @@ class CharmKubeVirtCharm(CharmBase):
                 return
             new_hash += controller.hash()
 
+        if self.stored.deployed and self.stored.config_hash == new_hash:
+            logger.info(
+                "Skipping reconcile, manifests already applied for this config."
+            )
+            self.stored.reconciled = inputs
+            self._update_status(event)
+            return
+
         self.stored.deployed = False
         if self._install_manifests(event, config_hash=new_hash):
             self.stored.config_hash = new_hash
             self.stored.deployed = True
+            self.stored.reconciled = inputs
             self._update_status(event)
 
+    def _reconcile_stats(self, event):
+        event.set_results(
+            {
+                "executed": self.stored.reconciles_executed,
+                "skipped": self.stored.reconciles_skipped,
+                "reconciled": self.stored.reconciled or "",
+            }
+        )
+
     def _setup_kvm(self, event) -> Optional[str]:
         """Apply machine changes to run qemu-kvm workloads."""
         if not self.stored.has_kvm:
@@ -262,8 +499,31 @@ class CharmKubeVirtCharm(CharmBase):
         kubevirt_expected = Path("/usr/libexec/qemu-kvm")
         if not kubevirt_expected.exists():
             kubevirt_expected.symlink_to(ubuntu_installed)
+
+        if self._check_config():
+            self._tune_host()
         return None
 
+    def _tune_host(self) -> None:
+        """Apply the host tuning config to a kvm capable host, and inform peers."""
+        if self.stored.has_kvm is not True:
+            return
+        root = self.kube_virt.root
+        tune_memory(
+            root,
+            parse_hugepages(str(self.config.get("hugepages") or "")),
+            parse_ksm(str(self.config.get("ksm") or "")),
+            str(self.config.get("transparent-hugepages") or ""),
+        )
+        nested = self.config.get("nested-virtualization")
+        halt_poll_ns = self.config.get("kvm-halt-poll-ns")
+        self.stored.kvm_reload_pending = not tune_kvm(
+            root,
+            None if nested is None else bool(nested),
+            None if halt_poll_ns is None else int(halt_poll_ns),
+        )
+        self.kube_virt.discover(self.stored.kvm_reload_pending)
+
     def _adjust_libvirtd_aa(self, event) -> Optional[str]:
         """Adjust usr.sbin.libvirtd apparmor profile."""
         if not self.stored.has_kvm:
@@ -344,6 +604,8 @@ class CharmKubeVirtCharm(CharmBase):
             logger.info("Skipping until the config is evaluated.")
             return True
         if self.unit.is_leader():
+            if not self._prepull_images(event):
+                return False
             self.unit.status = MaintenanceStatus("Deploying KubeVirt Operator")
             self.unit.set_workload_version("")
             for controller in self.collector.manifests.values():
@@ -354,6 +616,48 @@ class CharmKubeVirtCharm(CharmBase):
                     logger.warn(f"Encountered retryable installation error: {e}")
                     event.defer()
                     return False
+            self.kube_virt.deployed_release = self.kube_operator.current_release
+        return True
+
+    def _prepuller(self) -> PrePuller:
+        return PrePuller(
+            self.kube_operator.client, "kubevirt", [ConfigRegistry(self.kube_operator)]
+        )
+
+    def _prepull_images(self, event) -> bool:
+        """Pull the images of an upgraded release onto the nodes before applying it.
+
+        Returns True once enough nodes pulled every image, or when no pre-pull applies.
+        """
+        release = self.kube_operator.current_release
+        if not self.config.get("prepull-images") or self.kube_virt.deployed_release in (
+            None,
+            release,
+        ):
+            return True
+        images = self.kube_operator.release_images(release)
+        if not launcher_image(images):
+            logger.info(f"No virt-launcher image of {release} to pre-pull with")
+            return True
+        puller = self._prepuller()
+        threshold = int(self.config.get("prepull-threshold", 90))
+        try:
+            puller.apply(release, images)
+            progress = puller.progress(release, images)
+            if progress is None:
+                self._ops_wait_for(event, f"Pre-pulling {release} images")
+                return False
+            pulled, desired = progress
+            if pulled * 100 < desired * threshold:
+                msg = f"Pre-pulling {release} images: {pulled}/{desired} nodes"
+                self._ops_wait_for(event, msg)
+                return False
+            if not desired:
+                logger.info("No nodes are scheduled to pre-pull images")
+            puller.delete()
+        except ManifestClientError:
+            self._ops_wait_for(event, "Waiting for kube-apiserver", exc_info=True)
+            return False
         return True
 
     def _cleanup(self, event):
@@ -362,15 +666,22 @@ class CharmKubeVirtCharm(CharmBase):
 
         if self.unit.is_leader():
             self.unit.status = MaintenanceStatus("Cleaning up KubeVirt Operator")
-            for controller in self.collector.manifests.values():
-                try:
-                    controller.delete_manifests(ignore_unauthorized=True)
-                except ManifestClientError:
-                    self._ops_wait_for(
-                        event, "Waiting for kube-apiserver", exc_info=True
+            try:
+                self._prepuller().delete()
+                for controller in self.collector.manifests.values():
+                    labels = {APP_LABEL: self.app.name, MANIFEST_LABEL: controller.name}
+                    result = Teardown(controller.client, labels).run(
+                        controller.resources
                     )
-                    event.defer()
-                    return
+                    logger.info(f"Deleted {result.deleted} {controller.name} objects")
+                    if result.stuck:
+                        logger.warning(
+                            f"Objects left behind by {controller.name}: "
+                            + ", ".join(result.stuck)
+                        )
+            except ManifestClientError:
+                self._ops_wait_for(event, "Waiting for kube-apiserver", exc_info=True)
+                return
 
         self.unit.status = MaintenanceStatus("Shutting down")
 
@@ -5,6 +5,8 @@
 import logging
 from typing import Optional
 
+from kubevirt_host import THP_MODES, parse_hugepages, parse_ksm
+
 log = logging.getLogger(__name__)
 
 
@@ -17,6 +19,18 @@ class CharmConfig:
 
     def evaluate(self) -> Optional[str]:
         """Determine if configuration is valid."""
+        config = self.charm.config
+        try:
+            parse_hugepages(config.get("hugepages") or "")
+            parse_ksm(config.get("ksm") or "")
+        except ValueError as e:
+            return str(e)
+        thp = config.get("transparent-hugepages") or ""
+        if thp and thp not in THP_MODES:
+            return f"transparent-hugepages {thp} is not one of {', '.join(THP_MODES)}"
+        threshold = config.get("prepull-threshold")
+        if threshold is not None and not 0 <= threshold <= 100:
+            return f"prepull-threshold {threshold} is not a percentage from 0 to 100"
         return None
 
     @property
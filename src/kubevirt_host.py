@@ -0,0 +1,280 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Discovery of the host's virtualisation capabilities from /proc and /sys."""
+
+import logging
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+VIRT_FLAGS = ("vmx", "svm")
+# second level address translation, EPT on intel and NPT on amd
+SLAT_FLAGS = ("ept", "npt")
+KVM_MODULES = ("kvm_intel", "kvm_amd")
+# hugepage sizes accepted by config, mapped to their sysfs names
+HUGEPAGE_SIZES = {"2M": "2048kB", "1G": "1048576kB"}
+KSM_PARAMS = ("run", "pages_to_scan", "sleep_millisecs", "merge_across_nodes")
+THP_MODES = ("always", "madvise", "never")
+SYSCTL_CONF = "etc/sysctl.d/60-kubevirt.conf"
+TMPFILES_CONF = "etc/tmpfiles.d/kubevirt.conf"
+MODPROBE_CONF = "etc/modprobe.d/kubevirt-kvm.conf"
+KUBELET_CONFIG = "root/cdk/kubelet/config.yaml"
+KUBELET_ARGS = "var/snap/kubelet/current/args"
+
+
+def _read(path: Path) -> Optional[str]:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def _write(path: Path, value: str) -> bool:
+    try:
+        path.write_text(f"{value}\n")
+    except OSError as e:
+        log.warning(f"Could not write {value} to {path}: {e}")
+        return False
+    return True
+
+
+def _settings(value: str, name: str) -> Dict[str, int]:
+    """Parse space separated key=integer settings."""
+    settings = {}
+    for item in value.split():
+        key, _, number = item.partition("=")
+        if not number.isdigit():
+            raise ValueError(f"{name} {item!r} isn't formatted as key=integer")
+        settings[key] = int(number)
+    return settings
+
+
+def parse_hugepages(value: str) -> Dict[str, int]:
+    """Parse space separated size=pages into pages per sysfs hugepage size.
+
+    Raises:
+        ValueError: if a size is unsupported or the pages aren't an integer
+    """
+    pages = {}
+    for size, count in _settings(value, "hugepages").items():
+        if size not in HUGEPAGE_SIZES:
+            raise ValueError(
+                f"hugepages size {size} is not one of {', '.join(HUGEPAGE_SIZES)}"
+            )
+        pages[HUGEPAGE_SIZES[size]] = count
+    return pages
+
+
+def parse_ksm(value: str) -> Dict[str, int]:
+    """Parse space separated param=integer KSM settings.
+
+    Raises:
+        ValueError: if a param is unknown or its value isn't an integer
+    """
+    params = _settings(value, "ksm")
+    for param in params:
+        if param not in KSM_PARAMS:
+            raise ValueError(f"ksm {param} is not one of {', '.join(KSM_PARAMS)}")
+    return params
+
+
+@dataclass(frozen=True)
+class HostCapabilities:
+    """Virtualisation relevant facts about this host."""
+
+    cpu_vendor: str = ""
+    cpu_model: str = ""
+    virt_flags: List[str] = field(default_factory=list)
+    nested: bool = False
+    cores: int = 0
+    cpus: int = 0
+    numa_nodes: int = 0
+    # page size in kB mapped to (total, free) pages
+    hugepages: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    iommu: bool = False
+    cpu_manager_policy: str = "none"
+    isolated_cpus: int = 0
+
+    @property
+    def slat(self) -> bool:
+        """Whether the cpu supports EPT or NPT."""
+        return any(flag in self.virt_flags for flag in SLAT_FLAGS)
+
+
+def _cpuinfo(root: Path) -> Tuple[Mapping[str, str], int, int]:
+    """Details of the first processor, the logical cpu and physical core counts."""
+    first: Dict[str, str] = {}
+    cpus, cores = 0, set()
+    physical_id = ""
+    for line in (_read(root / "proc/cpuinfo") or "").splitlines():
+        key, _, value = (part.strip() for part in line.partition(":"))
+        if key == "processor":
+            cpus += 1
+        elif key == "physical id":
+            physical_id = value
+        elif key == "core id":
+            cores.add((physical_id, value))
+        if cpus == 1:
+            first.setdefault(key, value)
+    return first, cpus, len(cores) or cpus
+
+
+def _nested(root: Path) -> bool:
+    for module in KVM_MODULES:
+        value = _read(root / "sys/module" / module / "parameters/nested")
+        if value is not None:
+            return value in ("Y", "1")
+    return False
+
+
+def _hugepages(root: Path) -> Dict[str, Tuple[int, int]]:
+    pages = {}
+    for path in sorted((root / "sys/kernel/mm/hugepages").glob("hugepages-*")):
+        size = path.name.split("-", 1)[1]
+        total, free = (
+            _read(path / name) for name in ("nr_hugepages", "free_hugepages")
+        )
+        pages[size] = (int(total or 0), int(free or 0))
+    return pages
+
+
+def _cpu_count(cpu_list: str) -> int:
+    """Number of cpus in a kernel cpu list such as 0-3,8."""
+    count = 0
+    for part in filter(None, cpu_list.split(",")):
+        first, _, last = part.partition("-")
+        count += int(last or first) - int(first) + 1
+    return count
+
+
+def _cpu_manager_policy(root: Path) -> str:
+    """CPU manager policy of the kubelet, from its config file or arguments."""
+    try:
+        config = yaml.safe_load(_read(root / KUBELET_CONFIG) or "") or {}
+    except yaml.YAMLError:
+        log.warning("Could not parse the kubelet config")
+        config = {}
+    if policy := config.get("cpuManagerPolicy"):
+        return policy
+    for arg in (_read(root / KUBELET_ARGS) or "").split():
+        key, _, value = arg.partition("=")
+        if key == "--cpu-manager-policy":
+            return value.strip("\"'")
+    return "none"
+
+
+def probe(root: Path = Path("/")) -> HostCapabilities:
+    """Read the host's virtualisation capabilities below root."""
+    cpu, cpus, cores = _cpuinfo(root)
+    flags = set(cpu.get("flags", "").split())
+    iommu = root / "sys/class/iommu"
+    return HostCapabilities(
+        cpu_vendor=cpu.get("vendor_id", ""),
+        cpu_model=cpu.get("model name", ""),
+        virt_flags=sorted(flags.intersection(VIRT_FLAGS + SLAT_FLAGS)),
+        nested=_nested(root),
+        cores=cores,
+        cpus=cpus,
+        numa_nodes=len(list((root / "sys/devices/system/node").glob("node[0-9]*"))),
+        hugepages=_hugepages(root),
+        iommu=iommu.is_dir() and any(iommu.iterdir()),
+        cpu_manager_policy=_cpu_manager_policy(root),
+        isolated_cpus=_cpu_count(_read(root / "sys/devices/system/cpu/isolated") or ""),
+    )
+
+
+def tune_memory(
+    root: Path, hugepages: Mapping[str, int], ksm: Mapping[str, int], thp: str
+) -> None:
+    """Apply hugepage, KSM and transparent hugepage settings now and on boot.
+
+    2M pages persist through sysctl, the rest through tmpfiles.d writes to sysfs.
+    Runtime reservations may fall short when memory is fragmented, which probe
+    reports afterwards.
+    """
+    sysctl: Dict[str, str] = {}
+    sysfs: Dict[str, str] = {}
+    for size, count in hugepages.items():
+        path = f"sys/kernel/mm/hugepages/hugepages-{size}/nr_hugepages"
+        if size == HUGEPAGE_SIZES["2M"]:
+            sysctl["vm.nr_hugepages"] = str(count)
+            _write(root / path, str(count))
+        else:
+            sysfs[path] = str(count)
+    for param, number in ksm.items():
+        sysfs[f"sys/kernel/mm/ksm/{param}"] = str(number)
+    if thp:
+        sysfs["sys/kernel/mm/transparent_hugepage/enabled"] = thp
+    for path, value in sysfs.items():
+        _write(root / path, value)
+
+    persistent = {
+        SYSCTL_CONF: [f"{key} = {value}" for key, value in sysctl.items()],
+        TMPFILES_CONF: [f"w /{path} - - - - {value}" for path, value in sysfs.items()],
+    }
+    for conf, lines in persistent.items():
+        conf_path = root / conf
+        if lines:
+            conf_path.parent.mkdir(parents=True, exist_ok=True)
+            _write(conf_path, "\n".join(["# Managed by the kubevirt charm", *lines]))
+        else:
+            conf_path.unlink(missing_ok=True)
+
+
+def _kvm_module(root: Path) -> Optional[str]:
+    """The loaded vendor specific kvm module."""
+    for module in KVM_MODULES:
+        if (root / "sys/module" / module).is_dir():
+            return module
+    return None
+
+
+def vms_running(root: Path, module: str) -> bool:
+    """Whether any VM holds a reference to the kvm module."""
+    refcnt = _read(root / "sys/module" / module / "refcnt")
+    return bool(refcnt and refcnt.isdigit() and int(refcnt) > 0)
+
+
+def tune_kvm(root: Path, nested: Optional[bool], halt_poll_ns: Optional[int]) -> bool:
+    """Configure nested virtualisation and halt-polling of the kvm modules.
+
+    Options persist through modprobe.d. halt_poll_ns applies at runtime, while
+    nested requires reloading the module, which only happens with no VMs running.
+    Unset options are left to the host defaults.
+
+    Returns:
+        False if a module reload is still pending
+    """
+    module = _kvm_module(root)
+    lines = []
+    if module and nested is not None:
+        lines.append(f"options {module} nested={int(nested)}")
+    if halt_poll_ns is not None:
+        lines.append(f"options kvm halt_poll_ns={halt_poll_ns}")
+        _write(root / "sys/module/kvm/parameters/halt_poll_ns", str(halt_poll_ns))
+
+    conf = root / MODPROBE_CONF
+    if lines:
+        conf.parent.mkdir(parents=True, exist_ok=True)
+        _write(conf, "\n".join(["# Managed by the kubevirt charm", *lines]))
+    else:
+        conf.unlink(missing_ok=True)
+
+    if not module or nested is None or _nested(root) == nested:
+        return True
+    if vms_running(root, module):
+        log.info(f"Postponing reload of {module} while VMs are running")
+        return False
+    log.info(f"Reloading {module} with nested={int(nested)}")
+    try:
+        subprocess.check_call(["modprobe", "-r", module])
+        subprocess.check_call(["modprobe", module])
+    except subprocess.CalledProcessError:
+        log.exception(f"Could not reload {module}")
+        return False
+    return True
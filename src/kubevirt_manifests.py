@@ -2,14 +2,402 @@
 # See LICENSE file for licensing details.
 """Implementation of KubeVirt specific details of the kubernetes manifests."""
 
+import json
 import logging
-import pickle
-from hashlib import md5
-from typing import Dict, Optional
+import re
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from functools import lru_cache
+from hashlib import blake2b, sha256
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    KeysView,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    no_type_check,
+)
 
-from ops.manifests import ConfigRegistry, ManifestLabel, Manifests, Patch
+import yaml
+from httpx import HTTPError
+from lightkube import ApiError, codecs
+from lightkube.codecs import AnyResource
+from lightkube.generic_resource import (
+    create_global_resource,
+    create_namespaced_resource,
+    create_resources_from_crd,
+)
+from lightkube.models.core_v1 import EnvVar
+from ops.manifests import (
+    Addition,
+    ConfigRegistry,
+    HashableResource,
+    ManifestClientError,
+    ManifestLabel,
+    Manifests,
+    Patch,
+)
+from ops.manifests.literals import APP_LABEL, MANIFEST_LABEL, MANIFEST_VERSION_LABEL
+from ops.manifests.manifest import FILE_TYPES
+from ops.manifests.manipulations import Subtraction
+
+from kubevirt_migrations import parse_quantity
 
 log = logging.getLogger(__file__)
+_MISSING = object()
+DURATION_RE = re.compile(r"^([0-9]+(\.[0-9]+)?(ns|us|ms|s|m|h))+$")
+EVICTION_STRATEGIES = ("None", "LiveMigrate", "External")
+WORKLOAD_UPDATE_METHODS = ("LiveMigrate", "Evict")
+WORKLOAD_KINDS = frozenset(
+    {
+        "Pod",
+        "DaemonSet",
+        "Deployment",
+        "Job",
+        "ReplicaSet",
+        "ReplicationController",
+        "StatefulSet",
+        "CronJob",
+    }
+)
+# attributes leading to the pod spec of each workload kind
+POD_SPEC_PATHS = {
+    "Pod": ("spec",),
+    "CronJob": ("spec", "jobTemplate", "spec", "template", "spec"),
+    **{
+        kind: ("spec", "template", "spec")
+        for kind in WORKLOAD_KINDS - {"Pod", "CronJob"}
+    },
+}
+# images the virt-operator deploys itself, named relative to its own image
+OPERATOR_COMPONENTS = ("virt-api", "virt-controller", "virt-handler", "virt-launcher")
+# KubeVirt spec.configuration settings rendered by each performance-profile
+PERFORMANCE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "high-density": {
+        "developerConfiguration": {
+            "memoryOvercommit": 150,
+            "cpuAllocationRatio": 20,
+        },
+        "network": {"defaultNetworkInterface": "masquerade"},
+    },
+    "low-latency": {
+        "cpuModel": "host-passthrough",
+        "developerConfiguration": {
+            "featureGates": ["NUMA"],
+            "memoryOvercommit": 100,
+            "cpuAllocationRatio": 1,
+        },
+        "network": {
+            "defaultNetworkInterface": "bridge",
+            "permitBridgeInterfaceOnPodNetwork": True,
+        },
+    },
+}
+
+# rest client token-bucket limits of each component's spec.configuration field
+REST_CLIENT_COMPONENTS = {
+    "controller": "controllerConfiguration",
+    "handler": "handlerConfiguration",
+    "webhook": "webhookConfiguration",
+}
+# (minimum peer units, rest-client-rate-limits, infra-replicas) for automatic sizing
+CONTROL_PLANE_TIERS = [
+    (200, "controller=800/1600 webhook=800/1600", 5),
+    (50, "controller=400/800 webhook=400/800", 3),
+    (0, "", 0),
+]
+
+
+def pod_spec(obj) -> Optional[Any]:
+    """The pod spec of a workload resource, None for other kinds."""
+    path = POD_SPEC_PATHS.get(obj.kind)
+    spec = obj if path else None
+    for attr in path or ():
+        spec = getattr(spec, attr, None)
+    return spec
+
+
+def _inventory_path(
+    image: str, digests: Mapping[str, str]
+) -> Optional[Tuple[str, str]]:
+    """Split an image into its registry and the path keyed in the digests.
+
+    The registry may carry a path of its own, like rocks.canonical.com:443/cdk,
+    so the longest trailing path found in the digests is taken.
+    """
+    parts = image.split("/")
+    for idx in range(1, len(parts)):
+        path = "/".join(parts[idx:])
+        if path in digests:
+            return "/".join(parts[:idx]), path
+    return None
+
+
+def pin_image(image: str, digests: Mapping[str, str]) -> str:
+    """Reference an image by the digest of its tag, keeping its registry.
+
+    Args:
+        image: image reference, possibly already rewritten to another registry
+        digests: digests keyed by the tagged image reference without its registry
+    """
+    if "@" in image:
+        return image
+    found = _inventory_path(image, digests)
+    if not found or not digests[found[1]]:
+        return image
+    registry, path = found
+    return f"{registry}/{path.rsplit(':', 1)[0]}@{digests[path]}"
+
+
+def is_quantity(value: Any) -> bool:
+    """Whether a value is a non-negative kubernetes quantity, such as 64Mi or 1e3."""
+    try:
+        return parse_quantity(value) >= 0
+    except ValueError:
+        return False
+
+
+def control_plane_sizing(units: int) -> Tuple[str, int]:
+    """Rate limits and infra replicas suited to a cluster of this many units.
+
+    Small clusters keep the upstream defaults, represented as empty values.
+    """
+    for minimum, limits, replicas in CONTROL_PLANE_TIERS:
+        if units >= minimum:
+            return limits, replicas
+    return "", 0
+
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[int, int]]:
+    """Parse space separated component=qps/burst rate limits.
+
+    Raises:
+        ValueError: if a limit is malformed or names an unknown component
+    """
+    limits = {}
+    for item in value.split():
+        component, _, rate = item.partition("=")
+        qps, _, burst = rate.partition("/")
+        if component not in REST_CLIENT_COMPONENTS:
+            raise ValueError(f"unknown component {component!r} in {item!r}")
+        if not (qps.isdigit() and burst.isdigit()):
+            raise ValueError(f"{item!r} isn't formatted as component=qps/burst")
+        limits[component] = (int(qps), int(burst))
+    return limits
+
+
+# resource type of each component customisable by spec.customizeComponents
+CUSTOMIZABLE_COMPONENTS = {
+    "virt-api": "Deployment",
+    "virt-controller": "Deployment",
+    "virt-handler": "DaemonSet",
+}
+
+
+def parse_component_resources(value: str) -> Dict[str, Dict[str, Any]]:
+    """Parse the YAML mapping of component to resources and priority-class.
+
+    Raises:
+        ValueError: if the mapping is malformed or names unknown components
+    """
+    try:
+        components = yaml.safe_load(value) or {}
+    except yaml.YAMLError as e:
+        raise ValueError(f"isn't valid YAML: {e}") from e
+    if not isinstance(components, dict):
+        raise ValueError("must be a mapping of component names")
+    for component, settings in components.items():
+        if component not in CUSTOMIZABLE_COMPONENTS:
+            raise ValueError(f"unknown component {component!r}")
+        if not isinstance(settings, dict):
+            raise ValueError(f"{component} must be a mapping")
+        for key, quantities in settings.items():
+            if key == "priority-class":
+                continue
+            if key not in ("requests", "limits") or not isinstance(quantities, dict):
+                raise ValueError(f"{component} has unexpected {key!r}")
+            for resource, quantity in quantities.items():
+                if resource not in ("cpu", "memory"):
+                    raise ValueError(f"{component} {key} has unexpected {resource!r}")
+                if not is_quantity(quantity):
+                    raise ValueError(
+                        f"{component} {key}.{resource} {quantity} isn't a quantity"
+                    )
+    return components
+
+
+def component_patches(components: Mapping[str, Mapping]) -> List[Dict[str, str]]:
+    """Strategic merge patches of spec.customizeComponents sizing each component."""
+    patches = []
+    for component, settings in sorted(components.items()):
+        pod_spec: Dict[str, Any] = {}
+        if priority_class := settings.get("priority-class"):
+            pod_spec["priorityClassName"] = priority_class
+        resources = {
+            key: {name: str(quantity) for name, quantity in settings[key].items()}
+            for key in ("requests", "limits")
+            if settings.get(key)
+        }
+        if resources:
+            pod_spec["containers"] = [{"name": component, "resources": resources}]
+        if pod_spec:
+            patch = {"spec": {"template": {"spec": pod_spec}}}
+            patches.append(
+                {
+                    "resourceName": component,
+                    "resourceType": CUSTOMIZABLE_COMPONENTS[component],
+                    "patch": json.dumps(patch, sort_keys=True),
+                    "type": "strategic",
+                }
+            )
+    return patches
+
+
+def parse_node_selector(value: str) -> Dict[str, str]:
+    """Parse space separated key=value node labels.
+
+    Raises:
+        ValueError: if a label has no value
+    """
+    selector = {}
+    for item in value.split():
+        key, sep, label = item.partition("=")
+        if not (key and sep):
+            raise ValueError(f"{item!r} isn't formatted as key=value")
+        selector[key] = label
+    return selector
+
+
+def field_diff(old: Any, new: Any, path: str = "") -> Iterator[str]:
+    """Yield the dotted paths of every field which differs between old and new."""
+    if isinstance(old, Mapping) and isinstance(new, Mapping):
+        for key in sorted(set(old) | set(new), key=str):
+            sub_path = f"{path}.{key}" if path else str(key)
+            yield from field_diff(
+                old.get(key, _MISSING), new.get(key, _MISSING), sub_path
+            )
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for idx, (old_item, new_item) in enumerate(zip(old, new)):
+            yield from field_diff(old_item, new_item, f"{path}[{idx}]")
+    elif old != new:
+        yield path
+
+
+def drifted_fields(desired: Any, live: Any, path: str = "") -> Iterator[str]:
+    """Yield the dotted paths of desired fields which the live object doesn't match.
+
+    Fields only present in the live object, such as server defaults, aren't drift.
+    """
+    if isinstance(desired, Mapping) and isinstance(live, Mapping):
+        for key in sorted(desired, key=str):
+            sub_path = f"{path}.{key}" if path else str(key)
+            yield from drifted_fields(desired[key], live.get(key, _MISSING), sub_path)
+    elif (
+        isinstance(desired, list)
+        and isinstance(live, list)
+        and len(desired) == len(live)
+    ):
+        for idx, (desired_item, live_item) in enumerate(zip(desired, live)):
+            yield from drifted_fields(desired_item, live_item, f"{path}[{idx}]")
+    elif desired != live:
+        yield path
+
+
+def unsupported_fields(schema: Mapping, value: Any, path: str = "") -> Iterator[str]:
+    """Yield the dotted paths of fields in value which the openAPI schema doesn't define."""
+    if isinstance(value, list) and "items" in schema:
+        for idx, item in enumerate(value):
+            yield from unsupported_fields(schema["items"], item, f"{path}[{idx}]")
+        return
+    if not isinstance(value, Mapping):
+        return
+    properties = schema.get("properties")
+    if properties is None:
+        # free-form objects accept any field
+        return
+    for key in sorted(value, key=str):
+        sub_path = f"{path}.{key}" if path else str(key)
+        if key in properties:
+            yield from unsupported_fields(properties[key], value[key], sub_path)
+        else:
+            yield sub_path
+
+
+def merge_settings(dest: Dict, settings: Mapping) -> None:
+    """Merge nested settings into dest, extending lists with their missing items."""
+    for key, value in settings.items():
+        current = dest.get(key)
+        if isinstance(value, Mapping) and isinstance(current, dict):
+            merge_settings(current, value)
+        elif isinstance(value, list) and isinstance(current, list):
+            current.extend(item for item in value if item not in current)
+        else:
+            dest[key] = deepcopy(value)
+
+
+def _comparable(obj: AnyResource) -> Dict:
+    """Parts of a resource owned by the charm, without server-managed metadata."""
+    content = obj.to_dict()
+    metadata = content.pop("metadata", None) or {}
+    content.pop("status", None)
+    content["metadata"] = {
+        key: metadata[key] for key in ("labels", "annotations") if metadata.get(key)
+    }
+    return content
+
+
+def _canonical(value: Any) -> Iterator[bytes]:
+    """Serialise value in a type-tagged form independent of ordering and python version."""
+    if value is None:
+        yield b"n;"
+    elif isinstance(value, bool):
+        yield b"b1;" if value else b"b0;"
+    elif isinstance(value, (int, float)):
+        yield f"{type(value).__name__[0]}{value!r};".encode()
+    elif isinstance(value, str):
+        encoded = value.encode()
+        yield b"s%d:%s;" % (len(encoded), encoded)
+    elif isinstance(value, Mapping):
+        yield b"{"
+        for key in sorted(value, key=str):
+            yield from _canonical(str(key))
+            yield from _canonical(value[key])
+        yield b"}"
+    elif isinstance(value, (list, tuple)):
+        yield b"["
+        for item in value:
+            yield from _canonical(item)
+        yield b"]"
+    else:
+        raise TypeError(f"Cannot fingerprint {type(value).__name__}")
+
+
+def fingerprint(*values: Any) -> str:
+    """Stable digest of the canonical serialisation of values."""
+    hasher = blake2b(digest_size=16)
+    for value in values:
+        hasher.update(b"".join(_canonical(value)))
+    return hasher.hexdigest()
+
+
+class UpgradePlan(NamedTuple):
+    """Resources changed by moving from one release to another."""
+
+    current: str
+    target: str
+    added: List[str]
+    removed: List[str]
+    changed: Dict[str, List[str]]
+    unchanged: int
 
 
 class UpdateKubeVirt(Patch):
@@ -17,6 +405,9 @@ class UpdateKubeVirt(Patch):
 
     NAME = "kubevirt"
     REQUIRED = {"software-emulation", "pvc-tolerate-less-space-up-to-percent"}
+    # feature gates only usable when kvm units reserved hugepages
+    HUGEPAGE_GATES = ("NUMA",)
+    CPU_MANAGER_GATE = "CPUManager"
 
     def __call__(self, obj):
         """Update the kubevirt object."""
@@ -40,6 +431,186 @@ class UpdateKubeVirt(Patch):
         log.info(f"kubevirt pvcTolerateLessSpaceUpToPercent={pvc_toleration}%")
         dev_config["pvcTolerateLessSpaceUpToPercent"] = pvc_toleration
 
+        profile = self.manifests.config.get("performance-profile", "default")
+        settings = PERFORMANCE_PROFILES.get(profile)
+        if settings is None:
+            log.error(f"kubevirt performance-profile {profile} is unknown")
+        elif settings:
+            log.info(f"Applying kubevirt performance-profile {profile}")
+            merge_settings(obj.spec["configuration"], settings)
+
+        gates = dev_config.setdefault("featureGates", [])
+        if not self.manifests.config.get("hugepages-available"):
+            for gate in set(self.HUGEPAGE_GATES) & set(gates):
+                log.info(f"Disabling kubevirt {gate} feature gate without hugepages")
+                gates.remove(gate)
+        cpu_manager = self.manifests.config.get("cpu-manager-available")
+        if cpu_manager and self.CPU_MANAGER_GATE not in gates:
+            log.info(f"Enabling kubevirt {self.CPU_MANAGER_GATE} feature gate")
+            gates.append(self.CPU_MANAGER_GATE)
+        elif not cpu_manager and self.CPU_MANAGER_GATE in gates:
+            log.info(
+                f"Disabling kubevirt {self.CPU_MANAGER_GATE} feature gate "
+                "without the static cpu manager policy"
+            )
+            gates.remove(self.CPU_MANAGER_GATE)
+
+
+class UpdateMigrations(Patch):
+    """Render the live-migration settings into the CRD KubeVirt as a patch."""
+
+    # charm config key mapped to its spec.configuration.migrations field
+    SETTINGS = {
+        "migration-parallel-per-cluster": "parallelMigrationsPerCluster",
+        "migration-parallel-outbound-per-node": "parallelOutboundMigrationsPerNode",
+        "migration-bandwidth": "bandwidthPerMigration",
+        "migration-completion-timeout-per-gib": "completionTimeoutPerGiB",
+        "migration-progress-timeout": "progressTimeout",
+        "migration-allow-post-copy": "allowPostCopy",
+        "migration-allow-auto-converge": "allowAutoConverge",
+        "migration-network": "network",
+    }
+
+    @classmethod
+    def settings(cls, config: Mapping) -> Dict[str, Any]:
+        """The migrations block described by the charm config."""
+        return {
+            field: config[key] for key, field in cls.SETTINGS.items() if key in config
+        }
+
+    def __call__(self, obj):
+        """Update the kubevirt object."""
+        if not (obj.kind == "KubeVirt" and obj.metadata.name == UpdateKubeVirt.NAME):
+            return
+        migrations = self.settings(self.manifests.config)
+        if migrations:
+            log.info(f"kubevirt migrations={migrations}")
+            merge_settings(obj.spec["configuration"], {"migrations": migrations})
+
+
+class UpdateControlPlane(Patch):
+    """Size the KubeVirt control plane components in the CRD KubeVirt as a patch."""
+
+    def __call__(self, obj):
+        """Update the kubevirt object."""
+        if not (obj.kind == "KubeVirt" and obj.metadata.name == UpdateKubeVirt.NAME):
+            return
+        config = self.manifests.config
+        limits = parse_rate_limits(config.get("rest-client-rate-limits", ""))
+        for component, (qps, burst) in limits.items():
+            log.info(f"kubevirt {component} rest client qps={qps} burst={burst}")
+            bucket = {"tokenBucketRateLimiter": {"qps": qps, "burst": burst}}
+            merge_settings(
+                obj.spec["configuration"],
+                {
+                    REST_CLIENT_COMPONENTS[component]: {
+                        "restClient": {"rateLimiter": bucket}
+                    }
+                },
+            )
+
+        infra: Dict[str, Any] = {}
+        if replicas := config.get("infra-replicas"):
+            infra["replicas"] = replicas
+        if selector := parse_node_selector(config.get("infra-node-selector", "")):
+            infra["nodePlacement"] = {"nodeSelector": selector}
+        if infra:
+            log.info(f"kubevirt infra={infra}")
+            merge_settings(obj.spec, {"infra": infra})
+
+
+class UpdateComponents(Patch):
+    """Size the KubeVirt components through customizeComponents as a patch."""
+
+    def __call__(self, obj):
+        """Update the kubevirt object."""
+        if not (obj.kind == "KubeVirt" and obj.metadata.name == UpdateKubeVirt.NAME):
+            return
+        value = self.manifests.config.get("component-resources", "")
+        patches = component_patches(parse_component_resources(value))
+        if patches:
+            log.info(f"kubevirt customizeComponents for {len(patches)} components")
+            merge_settings(obj.spec, {"customizeComponents": {"patches": patches}})
+
+
+class UpdateWorkloads(Patch):
+    """Render the eviction and workload update strategies into the CRD KubeVirt."""
+
+    @staticmethod
+    def settings(config: Mapping) -> Dict[str, Any]:
+        """The KubeVirt spec settings described by the charm config."""
+        spec: Dict[str, Any] = {}
+        if strategy := config.get("eviction-strategy"):
+            spec["configuration"] = {"evictionStrategy": strategy}
+        update: Dict[str, Any] = {}
+        if methods := config.get("workload-update-methods", "").split():
+            update["workloadUpdateMethods"] = methods
+        if size := config.get("workload-update-batch-eviction-size"):
+            update["batchEvictionSize"] = size
+        if interval := config.get("workload-update-batch-eviction-interval"):
+            update["batchEvictionInterval"] = interval
+        if update:
+            spec["workloadUpdateStrategy"] = update
+        return spec
+
+    def __call__(self, obj):
+        """Update the kubevirt object."""
+        if not (obj.kind == "KubeVirt" and obj.metadata.name == UpdateKubeVirt.NAME):
+            return
+        if settings := self.settings(self.manifests.config):
+            log.info(f"kubevirt workload strategies={settings}")
+            merge_settings(obj.spec, settings)
+
+
+class PinImageDigests(Patch):
+    """Reference images by the digests pinned in the release inventory.
+
+    Runs after ConfigRegistry so the rewritten registry is kept. The
+    virt-operator is also told the digest of each component it deploys.
+    """
+
+    def __call__(self, obj):
+        """Pin the images of each container of a workload."""
+        spec = pod_spec(obj)
+        if not spec:
+            return
+        digests = self.manifests.image_digests(self.manifests.current_release)
+        if not digests:
+            return
+        for container in (spec.initContainers or []) + (spec.containers or []):
+            pinned = pin_image(container.image or "", digests)
+            if pinned != container.image:
+                log.info(f"Pinning Image: {container.image} to {pinned}")
+                container.image = pinned
+            self._pin_components(container, digests)
+
+    @staticmethod
+    def _pin_components(container, digests: Mapping[str, str]) -> None:
+        """Set the VIRT_<COMPONENT>_SHASUM environment of the virt-operator.
+
+        The operator only uses the digests once every component has one, so
+        they are set all together or not at all.
+        """
+        env = {e.name: e for e in container.env or []}
+        operator = env.get("OPERATOR_IMAGE")
+        found = operator and operator.value and _inventory_path(operator.value, digests)
+        if not found:
+            return
+        repository, tag = found[1].rsplit(":", 1)
+        prefix = repository.rsplit("/", 1)[0]
+        shasums = {
+            f"VIRT_{name[len('virt-') :].upper()}_SHASUM": digests.get(
+                f"{prefix}/{name}:{tag}"
+            )
+            for name in OPERATOR_COMPONENTS
+        }
+        if not all(shasums.values()) or set(shasums) & set(env):
+            return
+        log.info(f"Pinning {', '.join(OPERATOR_COMPONENTS)} by digest")
+        container.env = list(container.env) + [
+            EnvVar(name=name, value=digest) for name, digest in shasums.items()
+        ]
+
 
 class KubeVirtOperator(Manifests):
     """Deployment Specific details for the kubevirt-operator."""
@@ -49,29 +620,223 @@ class KubeVirtOperator(Manifests):
             ManifestLabel(self),
             ConfigRegistry(self),
             UpdateKubeVirt(self),
+            UpdateMigrations(self),
+            UpdateControlPlane(self),
+            UpdateComponents(self),
+            UpdateWorkloads(self),
+            PinImageDigests(self),
         ]
         super().__init__("kubevirt", charm.model, "upstream/operator", manipulations)
         self.unit = charm.unit
         self.charm_config = charm_config
         self.kube_control = kube_control
         self.kube_virts = kube_virts
+        self._kinds: Optional[FrozenSet[str]] = None
+        self._release: Optional[str] = None
+        self._config: Optional[Dict] = None
+        self._resources_memo: Optional[Tuple[Tuple, KeysView[HashableResource]]] = None
+
+    @contextmanager
+    def selected_release(self, release: str) -> Iterator[None]:
+        """Render the manifests of another release than the configured one."""
+        previous = self._release
+        self._release = release
+        try:
+            yield
+        finally:
+            self._release = previous
+
+    @contextmanager
+    def selected_kinds(self, kinds: Iterable[str]) -> Iterator[None]:
+        """Limit the loaded manifest resources to these kinds.
+
+        Releases with an index.json only parse the documents of the selected kinds.
+        An empty selection loads every resource.
+        """
+        previous = self._kinds
+        self._kinds = frozenset(k.lower() for k in kinds) or None
+        try:
+            yield
+        finally:
+            self._kinds = previous
+
+    @lru_cache()
+    def _release_index(self, release: str) -> Mapping:
+        """Read the document offset index of a release, if one was built."""
+        index = self.manifest_path / release / "index.json"
+        return json.loads(index.read_text()) if index.exists() else {}
+
+    @lru_cache()
+    def spec_schema(self, release: str) -> Mapping:
+        """The openAPI schema of the KubeVirt spec in a release.
+
+        Read from the fully parsed manifests, whose cache rendering the
+        resources shares, rather than parsing the CRD a second time.
+        """
+        release_path = self.manifest_path / release
+        ymls = sorted(m for ext in FILE_TYPES for m in release_path.glob(f"*.{ext}"))
+        parse = super()._safe_load
+        for crd in (rsc for yml in ymls for rsc in parse(yml)):
+            if crd["kind"] != "CustomResourceDefinition" or (
+                crd["spec"]["names"]["kind"] != "KubeVirt"
+            ):
+                continue
+            version = next(v for v in crd["spec"]["versions"] if v.get("storage", True))
+            return version["schema"]["openAPIV3Schema"]["properties"]["spec"]
+        return {}
+
+    def _safe_load(self, filepath: Path) -> List[Mapping]:  # type: ignore[override]
+        """Read only the documents of the selected kinds when the release is indexed."""
+        files = self._release_index(filepath.parent.name).get("files", {})
+        if self._kinds and filepath.name in files and self._index_current(filepath):
+            return self._indexed_load(filepath, self._kinds)
+        return super()._safe_load(filepath)
+
+    @lru_cache()
+    def _index_current(self, filepath: Path) -> bool:
+        """Whether the index of a manifest file still matches its content."""
+        files = self._release_index(filepath.parent.name)["files"]
+        if sha256(filepath.read_bytes()).hexdigest() == files[filepath.name]["sha256"]:
+            return True
+        log.warning(f"Ignoring stale index of {filepath}, parsing it fully")
+        return False
+
+    @lru_cache()
+    def _indexed_load(self, filepath: Path, kinds: FrozenSet[str]) -> List[Mapping]:
+        """Parse the indexed documents of a manifest file matching kinds."""
+        files = self._release_index(filepath.parent.name)["files"]
+        resources: List[Mapping] = []
+        with filepath.open("rb") as fp:
+            for doc in files[filepath.name]["documents"]:
+                kind = doc["kind"]
+                if kind.lower() in kinds or kind.endswith("List"):
+                    fp.seek(doc["offset"])
+                    rsc = yaml.safe_load(fp.read(doc["length"]))
+                    items = rsc.get("items", []) if kind.endswith("List") else [rsc]
+                    resources += [i for i in items if i["kind"].lower() in kinds]
+                elif crd := doc.get("crd"):
+                    # register the custom resource without parsing its definition
+                    creator = (
+                        create_namespaced_resource
+                        if crd["scope"] == "Namespaced"
+                        else create_global_resource
+                    )
+                    for version in crd["versions"]:
+                        creator(crd["group"], version, crd["kind"], crd["plural"])
+        return resources
+
+    @property
+    def resources(self) -> KeysView[HashableResource]:
+        """All unique component resources, rendered once per release, kinds and config.
+
+        Rendering isn't narrowed to the patches reading changed config keys: the
+        operator lives for a single hook and a config change arrives in a new
+        hook, so no earlier rendering would be left to reuse.
+        """
+        if any(isinstance(m, (Addition, Subtraction)) for m in self.manipulations):
+            return super().resources
+
+        release = self.current_release
+        key = (release, self._kinds, fingerprint(self.config))
+        if self._resources_memo is None or self._resources_memo[0] != key:
+            release_path = self.manifest_path / release
+            ymls = sorted(
+                m for ext in FILE_TYPES for m in release_path.glob(f"*.{ext}")
+            )
+            sources = [rsc for yml in ymls for rsc in self._safe_load(yml)]
+            patches = [m for m in self.manipulations if isinstance(m, Patch)]
+            objects = [self._render(source, patches) for source in sources]
+            rendered = OrderedDict((HashableResource(obj), None) for obj in objects)
+            self._resources_memo = (key, rendered.keys())
+        return self._resources_memo[1]
+
+    def _render(self, source: Mapping, patches: List[Patch]) -> AnyResource:
+        """Build a resource from an unpatched manifest document and patch it."""
+        obj = codecs.from_dict(deepcopy(dict(source)))
+        if obj.kind == "CustomResourceDefinition":
+            create_resources_from_crd(obj)  # type: ignore[arg-type]
+        for patch in patches:
+            patch(obj)
+        return obj
+
+    def manifest_digests(self) -> Dict[str, str]:
+        """Digest of each manifest file in the current release."""
+        release = self.current_release
+        files = self._release_index(release).get("files", {})
+        return {
+            path.name: files[path.name]["sha256"]
+            if path.name in files and self._index_current(path)
+            else sha256(path.read_bytes()).hexdigest()
+            for path in sorted((self.manifest_path / release).glob("*.yaml"))
+        }
+
+    @lru_cache()
+    def _inventory(self, release: str) -> List[Mapping]:
+        """Read the image inventory of a release, if one was built."""
+        inventory = self.manifest_path / release / "images.json"
+        return json.loads(inventory.read_text())["images"] if inventory.exists() else []
+
+    def release_images(self, release: str) -> List[str]:
+        """Images of a release from its inventory, preferring digests over tags."""
+        return [
+            f"{i['repository']}@{i['digest']}"
+            if i.get("digest")
+            else f"{i['repository']}:{i['tag']}"
+            if i.get("tag")
+            else i["repository"]
+            for i in self._inventory(release)
+        ]
+
+    def image_digests(self, release: str) -> Dict[str, str]:
+        """Pinned digests of a release keyed by tagged image, without its registry."""
+        return {
+            f"{i['repository'].split('/', 1)[-1]}:{i['tag']}": i["digest"]
+            for i in self._inventory(release)
+            if i.get("tag") and i.get("digest")
+        }
 
     def hash(self) -> int:
-        """Calculate a hash of the current configuration."""
-        return int(md5(pickle.dumps(self.config)).hexdigest(), 16)
+        """Calculate a fingerprint of the current config and release manifests."""
+        return int(fingerprint(self.config, self.manifest_digests()), 16)
+
+    def invalidate(self) -> None:
+        """Drop the config snapshot after relation data or charm config changes."""
+        self._config = None
 
     @property
     def config(self) -> Dict:
-        """Returns current config available from charm config and joined relations."""
-        config = {}
+        """Returns current config available from charm config and joined relations.
+
+        The config is gathered once per hook and memoised until invalidated.
+        """
+        if self._config is None:
+            self._config = self._gather_config()
+        config = dict(self._config)
+        if self._release:
+            config["release"] = self._release
+        return config
+
+    def _gather_config(self) -> Dict:
+        """Read config from charm config and joined relations."""
+        config: Dict[str, Any] = {}
         if self.kube_control.is_ready:
             config["image-registry"] = self.kube_control.get_registry_location()
 
+        units = 0
         if self.kube_virts.is_ready:
             config["software-emulation"] = not self.kube_virts.supports_kvm
+            config["hugepages-available"] = self.kube_virts.supports_hugepages
+            config["cpu-manager-available"] = self.kube_virts.supports_cpu_manager
+            units = self.kube_virts.unit_count
 
         config.update(**self.charm_config.available_data)
 
+        limits, replicas = control_plane_sizing(units)
+        if config.get("rest-client-rate-limits") == "auto":
+            config["rest-client-rate-limits"] = limits
+        if config.get("infra-replicas") == 0:
+            config["infra-replicas"] = replicas
+
         for key, value in dict(**config).items():
             if value == "" or value is None:
                 del config[key]
@@ -82,18 +847,215 @@ class KubeVirtOperator(Manifests):
 
     def evaluate(self) -> Optional[str]:
         """Determine if manifest_config can be applied to manifests."""
+        config = self.config
         props = UpdateKubeVirt.REQUIRED
         for prop in props:
-            value = self.config.get(prop)
+            value = config.get(prop)
             if value is None:
                 return f"KubeVirt manifests waiting for definition of {prop}"
 
-        percent = self.config.get("pvc-tolerate-less-space-up-to-percent")
+        percent = config.get("pvc-tolerate-less-space-up-to-percent")
         if percent is not None and not (0 < percent < 100):
             return f"pvc-tolerate-less-space-up-to-percent is not in range: 0 < {percent} < 100"
 
+        profile = config.get("performance-profile", "default")
+        if profile not in PERFORMANCE_PROFILES:
+            return (
+                f"performance-profile {profile} is not one of "
+                f"{', '.join(PERFORMANCE_PROFILES)}"
+            )
+        schema = self.spec_schema(self.current_release)
+        unsupported = list(
+            unsupported_fields(schema, {"configuration": PERFORMANCE_PROFILES[profile]})
+        )
+        if unsupported:
+            return (
+                f"performance-profile {profile} unsupported by {self.current_release}: "
+                f"{', '.join(unsupported)}"
+            )
+
+        return (
+            self._evaluate_migrations(config, schema)
+            or self._evaluate_control_plane(config)
+            or self._evaluate_components(config, schema)
+            or self._evaluate_workloads(config, schema)
+        )
+
+    def _evaluate_migrations(self, config: Mapping, schema: Mapping) -> Optional[str]:
+        """Validate the live-migration settings of the charm config."""
+        for key in UpdateMigrations.SETTINGS:
+            value = config.get(key)
+            if isinstance(value, int) and not isinstance(value, bool) and value < 1:
+                return f"{key} must be a positive integer, not {value}"
+        bandwidth = config.get("migration-bandwidth")
+        if bandwidth is not None and not is_quantity(bandwidth):
+            return f"migration-bandwidth {bandwidth} is not a quantity such as 64Mi"
+        migrations = {
+            "configuration": {"migrations": UpdateMigrations.settings(config)}
+        }
+        unsupported = list(unsupported_fields(schema, migrations))
+        if unsupported:
+            return (
+                f"migration settings unsupported by {self.current_release}: "
+                f"{', '.join(unsupported)}"
+            )
         return None
 
+    def _evaluate_control_plane(self, config: Mapping) -> Optional[str]:
+        """Validate the control plane sizing of the charm config."""
+        try:
+            parse_rate_limits(config.get("rest-client-rate-limits", ""))
+        except ValueError as e:
+            return f"rest-client-rate-limits: {e}"
+        try:
+            parse_node_selector(config.get("infra-node-selector", ""))
+        except ValueError as e:
+            return f"infra-node-selector: {e}"
+        replicas = config.get("infra-replicas", 0)
+        if replicas < 0:
+            return f"infra-replicas must not be negative, not {replicas}"
+        return None
+
+    def _evaluate_components(self, config: Mapping, schema: Mapping) -> Optional[str]:
+        """Validate the component sizing of the charm config."""
+        try:
+            components = parse_component_resources(
+                config.get("component-resources", "")
+            )
+        except ValueError as e:
+            return f"component-resources {e}"
+        customized = {"customizeComponents": {"patches": component_patches(components)}}
+        unsupported = list(unsupported_fields(schema, customized))
+        if unsupported:
+            return (
+                f"component-resources unsupported by {self.current_release}: "
+                f"{', '.join(unsupported)}"
+            )
+        return None
+
+    def _evaluate_workloads(self, config: Mapping, schema: Mapping) -> Optional[str]:
+        """Validate the eviction and workload update strategies of the charm config."""
+        strategy = config.get("eviction-strategy")
+        if strategy and strategy not in EVICTION_STRATEGIES:
+            return (
+                f"eviction-strategy {strategy} is not one of "
+                f"{', '.join(EVICTION_STRATEGIES)}"
+            )
+        for method in config.get("workload-update-methods", "").split():
+            if method not in WORKLOAD_UPDATE_METHODS:
+                return (
+                    f"workload-update-methods {method} is not one of "
+                    f"{', '.join(WORKLOAD_UPDATE_METHODS)}"
+                )
+        size = config.get("workload-update-batch-eviction-size")
+        if size is not None and size < 1:
+            return f"workload-update-batch-eviction-size must be positive, not {size}"
+        interval = config.get("workload-update-batch-eviction-interval")
+        if interval and not DURATION_RE.match(interval):
+            return (
+                f"workload-update-batch-eviction-interval {interval} "
+                "is not a duration such as 1m30s"
+            )
+        unsupported = list(unsupported_fields(schema, UpdateWorkloads.settings(config)))
+        if unsupported:
+            return (
+                f"workload strategies unsupported by {self.current_release}: "
+                f"{', '.join(unsupported)}"
+            )
+        return None
+
+    @property
+    def control_plane(self) -> Dict[str, str]:
+        """Control plane sizing rendered into the KubeVirt resource."""
+        config = self.config
+        return {
+            "rest-client-rate-limits": config.get("rest-client-rate-limits")
+            or "defaults",
+            "infra-replicas": str(config.get("infra-replicas") or "default"),
+        }
+
+    def _document_digests(self, release: str) -> Dict[str, str]:
+        """Digest of each unrendered resource in a release, from its index."""
+        files = self._release_index(release).get("files", {})
+        return {
+            "/".join(filter(None, (doc["kind"], doc["namespace"], doc["name"]))): sha
+            for manifest in files.values()
+            for doc in manifest["documents"]
+            if (sha := doc.get("sha256"))
+        }
+
+    def _rendered(self) -> Dict[str, Dict]:
+        """Rendered resources keyed by kind/[namespace/]name, ignoring the version label."""
+        rendered = {}
+        for rsc in self.resources:
+            obj = deepcopy(rsc.resource.to_dict())
+            labels = obj.get("metadata", {}).get("labels", {})
+            labels.pop(MANIFEST_VERSION_LABEL, None)
+            rendered[str(rsc)] = obj
+        return rendered
+
+    def plan_upgrade(self, target: str) -> UpgradePlan:
+        """Compare the rendered resources of the current and target releases.
+
+        Resources whose source documents have identical digests in both
+        releases are rendered the same, and skip the field comparison.
+        """
+        current = self.current_release
+        with self.selected_release(current):
+            before = self._rendered()
+        with self.selected_release(target):
+            after = self._rendered()
+        digests = self._document_digests(current), self._document_digests(target)
+
+        changed, unchanged = {}, 0
+        for key in sorted(before.keys() & after.keys()):
+            same_source = digests[0].get(key) and digests[0].get(key) == digests[1].get(
+                key
+            )
+            fields = [] if same_source else list(field_diff(before[key], after[key]))
+            if fields:
+                changed[key] = fields
+            else:
+                unchanged += 1
+        return UpgradePlan(
+            current,
+            target,
+            added=sorted(after.keys() - before.keys()),
+            removed=sorted(before.keys() - after.keys()),
+            changed=changed,
+            unchanged=unchanged,
+        )
+
+    @no_type_check
+    def drift(self) -> Dict[HashableResource, List[str]]:
+        """Compare live objects against the rendered resources.
+
+        Each kind is listed once per namespace with the charm's label selector.
+        Returns the drifted or missing resources with the fields that differ.
+        """
+        groups = defaultdict(list)
+        for rsc in self.resources:
+            groups[(rsc.namespace, type(rsc.resource))].append(rsc)
+
+        drifted: Dict[HashableResource, List[str]] = {}
+        labels = {APP_LABEL: self.model.app.name, MANIFEST_LABEL: self.name}
+        for (namespace, kind), expected in groups.items():
+            try:
+                listed = self.client.list(kind, namespace=namespace, labels=labels)
+                live = {HashableResource(obj): obj for obj in listed}
+            except (ApiError, HTTPError) as ex:
+                msg = f"Failed listing {kind.__name__} resources"
+                log.exception(msg)
+                raise ManifestClientError(msg, ex) from ex
+            for rsc in expected:
+                if (obj := live.get(rsc)) is None:
+                    drifted[rsc] = ["missing"]
+                elif fields := list(
+                    drifted_fields(_comparable(rsc.resource), _comparable(obj))
+                ):
+                    drifted[rsc] = fields
+        return drifted
+
     @property
     def phases(self):
         """Details phases of resources in this manifest."""
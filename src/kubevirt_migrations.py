@@ -0,0 +1,420 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Live migration of VirtualMachineInstances off nodes."""
+
+import logging
+import queue
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from httpx import HTTPError
+from lightkube import ApiError, Client
+from lightkube.generic_resource import create_namespaced_resource
+from lightkube.models.meta_v1 import ObjectMeta
+from lightkube.resources.core_v1 import Node
+from ops.manifests import ManifestClientError
+
+log = logging.getLogger(__name__)
+
+VirtualMachineInstance = create_namespaced_resource(
+    "kubevirt.io", "v1", "VirtualMachineInstance", "virtualmachineinstances"
+)
+VirtualMachineInstanceMigration = create_namespaced_resource(
+    "kubevirt.io",
+    "v1",
+    "VirtualMachineInstanceMigration",
+    "virtualmachineinstancemigrations",
+)
+# label virt-handler sets on each VMI with the node it runs on
+NODE_LABEL = "kubevirt.io/nodeName"
+# label identifying migrations issued by the charm
+MIGRATION_LABEL = "kubevirt.charm/migration"
+FINAL_PHASES = ("Succeeded", "Failed")
+# phases reported for the VMIs a migrate timeout left unfinished
+TIMED_OUT = "TimedOut"
+NOT_STARTED = "NotStarted"
+# upstream defaults of spec.configuration.migrations
+DEFAULT_PER_CLUSTER = 5
+DEFAULT_PER_NODE = 2
+# label virt-handler sets on nodes able to run VMIs
+SCHEDULABLE_LABEL = "kubevirt.io/schedulable"
+# signed number followed by a decimal exponent or a suffix
+QUANTITY_RE = re.compile(
+    r"^([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))(?:[eE]([+-]?[0-9]+)|([a-zA-Z]*))$"
+)
+# suffixes of kubernetes quantities, where K is no valid suffix but 1E3 is 1000
+QUANTITY_SUFFIXES = {
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+}
+# cpu requested by a VMI which requests none, as defaulted by KubeVirt
+DEFAULT_VMI_CPU = 0.1
+
+
+class VMIRef(NamedTuple):
+    """A VirtualMachineInstance and the node it runs on."""
+
+    namespace: str
+    name: str
+    node: str
+
+    def __str__(self):
+        """Namespaced name of the VMI."""
+        return f"{self.namespace}/{self.name}"
+
+
+class MigrationResult(NamedTuple):
+    """Outcome of one live migration."""
+
+    vmi: VMIRef
+    phase: str
+    duration: float
+
+
+def parse_quantity(quantity: Any) -> float:
+    """Convert a kubernetes quantity such as 500m, 4Gi or 1e3 into a number.
+
+    Raises:
+        ValueError: when the quantity doesn't follow the kubernetes grammar
+    """
+    match = QUANTITY_RE.match(str(quantity))
+    if not match or (match[3] and match[3] not in QUANTITY_SUFFIXES):
+        raise ValueError(f"{quantity!r} isn't a kubernetes quantity")
+    number, exponent, suffix = match.groups()
+    if exponent is not None:
+        return float(f"{number}e{exponent}")
+    return float(number) * QUANTITY_SUFFIXES.get(suffix, 1)
+
+
+class VMILoad(NamedTuple):
+    """Resources requested by a VMI, and whether it may be migrated."""
+
+    vmi: VMIRef
+    cpu: float
+    memory: float
+    migratable: bool
+
+
+class PlannedMove(NamedTuple):
+    """A VMI to move from its node towards a less loaded node."""
+
+    vmi: VMIRef
+    target: str
+
+
+def is_migratable(vmi) -> bool:
+    """Whether a VMI reports the LiveMigratable condition."""
+    conditions = (vmi.get("status") or {}).get("conditions") or []
+    return any(
+        c.get("type") == "LiveMigratable" and c.get("status") == "True"
+        for c in conditions
+    )
+
+
+class Migrator:
+    """Live migrates VMIs in bounded parallel batches, watching their progress.
+
+    Args:
+        client: lightkube client of the cluster
+        per_cluster: migrations in flight across the cluster
+        per_node: migrations in flight leaving any one node
+        label: value of MIGRATION_LABEL on the issued migrations
+        clock: monotonic time source
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        per_cluster: int = DEFAULT_PER_CLUSTER,
+        per_node: int = DEFAULT_PER_NODE,
+        label: str = "drain",
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.client = client
+        self.per_cluster = max(per_cluster, 1)
+        self.per_node = max(per_node, 1)
+        self.label = label
+        self.clock = clock
+
+    def _call(self, msg: str, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except (ApiError, HTTPError) as ex:
+            log.exception(msg)
+            raise ManifestClientError(msg, ex) from ex
+
+    def cordon(self, nodes: Iterable[str]) -> None:
+        """Mark nodes unschedulable so that VMIs don't migrate onto them."""
+        for node in nodes:
+            self._call(
+                f"Failed cordoning {node}",
+                self.client.patch,
+                Node,
+                node,
+                {"spec": {"unschedulable": True}},
+            )
+
+    def vmis_on(self, nodes: Iterable[str]) -> Tuple[List[VMIRef], List[VMIRef]]:
+        """List the migratable and unmigratable VMIs on nodes, once per node."""
+        migratable: List[VMIRef] = []
+        pinned: List[VMIRef] = []
+        for node in nodes:
+            listed = self._call(
+                f"Failed listing VirtualMachineInstances on {node}",
+                self._list_vmis,
+                node,
+            )
+            for vmi in listed:
+                content = vmi.to_dict()
+                ref = VMIRef(vmi.metadata.namespace, vmi.metadata.name, node)
+                (migratable if is_migratable(content) else pinned).append(ref)
+        return migratable, pinned
+
+    def _list_vmis(self, node: str) -> List:
+        return list(
+            self.client.list(
+                VirtualMachineInstance, namespace="*", labels={NODE_LABEL: node}
+            )
+        )
+
+    def snapshot(self) -> Tuple[Dict[str, Tuple[float, float]], List[VMILoad]]:
+        """List the allocatable resources of VMI nodes and the requests of every VMI.
+
+        Nodes and VMIs are each listed once.
+        """
+        nodes = self._call(
+            "Failed listing nodes",
+            lambda: list(self.client.list(Node, labels={SCHEDULABLE_LABEL: "true"})),
+        )
+        capacity = {}
+        for node in nodes:
+            allocatable = node.status.allocatable if node.status else None
+            if allocatable:
+                capacity[node.metadata.name] = (
+                    parse_quantity(allocatable["cpu"]),
+                    parse_quantity(allocatable["memory"]),
+                )
+        vmis = self._call(
+            "Failed listing VirtualMachineInstances",
+            lambda: list(self.client.list(VirtualMachineInstance, namespace="*")),
+        )
+        loads = []
+        for vmi in vmis:
+            content = vmi.to_dict()
+            node = content["metadata"].get("labels", {}).get(NODE_LABEL)
+            if not node:
+                continue
+            domain = content.get("spec", {}).get("domain", {})
+            requests = domain.get("resources", {}).get("requests", {})
+            memory = requests.get("memory") or domain.get("memory", {}).get("guest", 0)
+            loads.append(
+                VMILoad(
+                    VMIRef(vmi.metadata.namespace, vmi.metadata.name, node),
+                    parse_quantity(requests.get("cpu", DEFAULT_VMI_CPU)),
+                    parse_quantity(memory),
+                    is_migratable(content),
+                )
+            )
+        return capacity, loads
+
+    def _start(self, vmi: VMIRef) -> str:
+        migration = VirtualMachineInstanceMigration(
+            metadata=ObjectMeta(
+                generateName=f"{vmi.name}-",
+                namespace=vmi.namespace,
+                labels={MIGRATION_LABEL: self.label},
+            ),
+            spec={"vmiName": vmi.name},
+        )
+        created = self._call(
+            f"Failed creating a migration of {vmi}", self.client.create, migration
+        )
+        log.info(f"Migrating {vmi} off {vmi.node} with {created.metadata.name}")
+        return created.metadata.name
+
+    def _events(self, deadline: Optional[float]) -> Iterator:
+        """Watch the charm's migrations, stopping once the deadline passes.
+
+        The watch blocks until the next event, so with a deadline it is read
+        by a daemon thread and its events are awaited at most until then.
+        """
+        watch = self.client.watch(
+            VirtualMachineInstanceMigration,
+            namespace="*",
+            labels={MIGRATION_LABEL: self.label},
+        )
+        if deadline is None:
+            yield from watch
+            return
+        events: queue.Queue = queue.Queue()
+
+        def forward():
+            try:
+                for event in watch:
+                    events.put(event)
+            except Exception as ex:
+                events.put(ex)
+
+        threading.Thread(target=forward, daemon=True).start()
+        while (remaining := deadline - self.clock()) > 0:
+            try:
+                event = events.get(timeout=remaining)
+            except queue.Empty:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    def migrate(
+        self,
+        vmis: Iterable[VMIRef],
+        progress: Optional[Callable[[MigrationResult], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> List[MigrationResult]:
+        """Migrate each VMI, keeping the cluster and per node limits in flight.
+
+        A single watch of the charm's migrations reports their completion,
+        each freeing a slot for the next pending VMI. Once the timeout passes
+        the watch stops, reporting the migrations still in flight as TimedOut
+        and the VMIs never started as NotStarted. Timed out migrations are
+        left running in the cluster.
+        """
+        pending: Dict[str, Deque[VMIRef]] = defaultdict(deque)
+        for vmi in vmis:
+            pending[vmi.node].append(vmi)
+        in_flight: Dict[Tuple[str, str], Tuple[VMIRef, float]] = {}
+        leaving: Counter = Counter()
+        results: List[MigrationResult] = []
+
+        def fill():
+            for node, queued in pending.items():
+                while (
+                    queued
+                    and leaving[node] < self.per_node
+                    and len(in_flight) < self.per_cluster
+                ):
+                    vmi = queued.popleft()
+                    name = self._start(vmi)
+                    in_flight[(vmi.namespace, name)] = (vmi, self.clock())
+                    leaving[node] += 1
+
+        deadline = None if timeout is None else self.clock() + timeout
+        fill()
+        if not in_flight:
+            return results
+        try:
+            for _, migration in self._events(deadline):
+                content = migration.to_dict()
+                metadata = content["metadata"]
+                key = (metadata.get("namespace"), metadata["name"])
+                phase = (content.get("status") or {}).get("phase")
+                if key not in in_flight or phase not in FINAL_PHASES:
+                    continue
+                vmi, started = in_flight.pop(key)
+                leaving[vmi.node] -= 1
+                result = MigrationResult(vmi, phase, self.clock() - started)
+                results.append(result)
+                if progress:
+                    progress(result)
+                fill()
+                if not in_flight:
+                    break
+        except (ApiError, HTTPError) as ex:
+            msg = "Failed watching VirtualMachineInstanceMigrations"
+            log.exception(msg)
+            raise ManifestClientError(msg, ex) from ex
+        unfinished = [
+            MigrationResult(vmi, TIMED_OUT, self.clock() - started)
+            for vmi, started in in_flight.values()
+        ] + [
+            MigrationResult(vmi, NOT_STARTED, 0.0)
+            for queued in pending.values()
+            for vmi in queued
+        ]
+        if unfinished:
+            log.warning(f"{len(unfinished)} migrations unfinished after {timeout}s")
+        for result in unfinished:
+            results.append(result)
+            if progress:
+                progress(result)
+        return results
+
+
+def plan_rebalance(
+    capacity: Mapping[str, Tuple[float, float]],
+    vmis: Iterable[VMILoad],
+    max_migrations: int,
+) -> List[PlannedMove]:
+    """Plan migrations evening out the cpu and memory requests across nodes.
+
+    A node's load is the mean of its requested cpu and memory fractions. Each
+    step moves the migratable VMI of the most loaded node that best reduces the
+    sum of squared loads when moved to the least loaded node, and stops once
+    no such move improves the balance.
+
+    Args:
+        capacity: allocatable cpu and memory of each node
+        vmis: requests of the VMIs running on those nodes
+        max_migrations: upper bound on the planned moves
+    """
+    load = dict.fromkeys(capacity, 0.0)
+    movable: Dict[str, List[VMILoad]] = defaultdict(list)
+
+    def weight(vmi: VMILoad, node: str) -> float:
+        cpu, memory = capacity[node]
+        return (vmi.cpu / cpu + vmi.memory / memory) / 2
+
+    for vmi in vmis:
+        if vmi.vmi.node not in load:
+            continue
+        load[vmi.vmi.node] += weight(vmi, vmi.vmi.node)
+        if vmi.migratable:
+            movable[vmi.vmi.node].append(vmi)
+
+    plan: List[PlannedMove] = []
+    while len(plan) < max_migrations and len(load) > 1:
+        source = max(load, key=load.__getitem__)
+        target = min(load, key=load.__getitem__)
+        before = load[source] ** 2 + load[target] ** 2
+        best, best_gain = None, 0.0
+        for idx, vmi in enumerate(movable[source]):
+            after = (load[source] - weight(vmi, source)) ** 2 + (
+                load[target] + weight(vmi, target)
+            ) ** 2
+            if before - after > best_gain:
+                best, best_gain = idx, before - after
+        if best is None:
+            break
+        vmi = movable[source].pop(best)
+        load[source] -= weight(vmi, source)
+        load[target] += weight(vmi, target)
+        plan.append(PlannedMove(vmi.vmi, target))
+    return plan
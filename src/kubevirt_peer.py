@@ -2,16 +2,20 @@
 # See LICENSE file for licensing details.
 """Implementation of kubevirts relation (peers)."""
 
+import json
 import logging
 from functools import cached_property
+from hashlib import blake2b
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from ops.charm import CharmBase, RelationBrokenEvent
 from ops.framework import Object
 from ops.model import Relation
 from pydantic import BaseModel, Field, Json, ValidationError
 
+from kubevirt_host import HostCapabilities, probe
+
 log = logging.getLogger("KubeControlRequirer")
 
 
@@ -19,14 +23,51 @@ class Data(BaseModel):
     """Data aquired from the kubevirts peer relation."""
 
     supports_kvm: Json[bool] = Field(alias="supports-kvm")
+    cpu_vendor: Optional[str] = Field(alias="cpu-vendor")
+    cpu_model: Optional[str] = Field(alias="cpu-model")
+    virt_flags: Optional[Json[List[str]]] = Field(alias="virt-flags")
+    nested: Optional[Json[bool]] = Field(alias="nested-virt")
+    cores: Optional[Json[int]]
+    cpus: Optional[Json[int]]
+    numa_nodes: Optional[Json[int]] = Field(alias="numa-nodes")
+    hugepages: Optional[Json[Dict[str, int]]]
+    iommu: Optional[Json[bool]]
+    kvm_reload_pending: Optional[Json[bool]] = Field(alias="kvm-reload-pending")
+    cpu_manager_policy: Optional[str] = Field(alias="cpu-manager-policy")
+    isolated_cpus: Optional[Json[int]] = Field(alias="isolated-cpus")
+
+
+class Summary(BaseModel):
+    """Capabilities of all peers, aggregated by the leader in the app databag."""
+
+    units: Json[int]
+    kvm_units: Json[int] = Field(alias="kvm-units")
+    hugepages_units: Json[int] = Field(0, alias="hugepages-units")
+    cpu_manager_units: Json[int] = Field(0, alias="cpu-manager-units")
+    digest: str
+    generation: Json[int]
+
+
+def _has_hugepages(data: Data) -> bool:
+    """Whether a kvm capable unit has reserved hugepages of any size."""
+    pages = data.hugepages or {}
+    return data.supports_kvm and any(pages.values())
+
+
+def _has_cpu_manager(data: Data) -> bool:
+    """Whether a kvm capable unit's kubelet runs the static cpu manager."""
+    return data.supports_kvm and data.cpu_manager_policy == "static"
 
 
 class KubeVirtPeer(Object):
     """Manages data exchange across the kubevirts relation."""
 
-    def __init__(self, charm: CharmBase, endpoint: str = "kubevirts"):
+    def __init__(
+        self, charm: CharmBase, endpoint: str = "kubevirts", root: Path = Path("/")
+    ):
         super().__init__(charm, f"relation-{endpoint}")
         self.endpoint = endpoint
+        self.root = root
 
     @cached_property
     def relation(self) -> Optional[Relation]:
@@ -37,9 +78,68 @@ class KubeVirtPeer(Object):
     def _data(self) -> List[Data]:
         if self.relation:
             units = self.relation.units | {self.model.unit}
-            return [Data(**self.relation.data[u]) for u in units]
+            return [Data.parse_obj(self.relation.data[u]) for u in units]
         return []
 
+    def invalidate(self) -> None:
+        """Forget cached relation data so that it is read again."""
+        for cached in ("relation", "_data", "summary"):
+            self.__dict__.pop(cached, None)
+
+    def _digest(self) -> str:
+        """Digest of the raw databags of every unit, without validating them."""
+        assert self.relation
+        units = self.relation.units | {self.model.unit}
+        raw = {u.name: dict(self.relation.data[u]) for u in units}
+        content = json.dumps(raw, sort_keys=True).encode()
+        return blake2b(content, digest_size=16).hexdigest()
+
+    def publish_summary(self) -> Optional[Summary]:
+        """As leader, aggregate the peers' data into the app databag.
+
+        Peers are only parsed again when their raw data changed since the
+        last published summary.
+        """
+        if not (self.relation and self.model.unit.is_leader()):
+            return None
+        app_data = self.relation.data[self.model.app]
+        digest = self._digest()
+        try:
+            published = Summary.parse_obj(app_data)
+        except ValidationError:
+            published = None
+        if published and published.digest == digest:
+            return published
+
+        try:
+            data = self._data
+        except ValidationError as ve:
+            log.error(f"{self.endpoint} relation data not yet valid. ({ve}")
+            return None
+        generation = published.generation + 1 if published else 1
+        content = {
+            "units": str(len(data)),
+            "kvm-units": str(sum(_.supports_kvm for _ in data)),
+            "hugepages-units": str(sum(_has_hugepages(_) for _ in data)),
+            "cpu-manager-units": str(sum(_has_cpu_manager(_) for _ in data)),
+            "digest": digest,
+            "generation": str(generation),
+        }
+        app_data.update(content)
+        return Summary.parse_obj(content)
+
+    @cached_property
+    def summary(self) -> Optional[Summary]:
+        """Aggregated peer capabilities, published by the leader."""
+        if not self.relation:
+            return None
+        if self.model.unit.is_leader():
+            return self.publish_summary()
+        try:
+            return Summary.parse_obj(self.relation.data[self.model.app])
+        except ValidationError:
+            return None
+
     def evaluate_relation(self, event) -> Optional[str]:
         """Determine if relation is ready."""
         no_relation = not self.relation or (
@@ -54,6 +154,8 @@ class KubeVirtPeer(Object):
     @property
     def is_ready(self):
         """Whether the request for this instance has been completed."""
+        if self.summary:
+            return self.summary.units > 0
         try:
             self._data
         except ValidationError as ve:
@@ -67,16 +169,108 @@ class KubeVirtPeer(Object):
     @property
     def dev_kvm_exists(self) -> bool:
         """Returns true if /dev/kvm exists."""
-        return Path("/dev/kvm").exists()
+        return (self.root / "dev/kvm").exists()
+
+    @property
+    def host(self) -> HostCapabilities:
+        """Virtualisation capabilities of this host."""
+        return probe(self.root)
 
-    def discover(self) -> None:
-        """Determine if this host supports kvm, and informs peers."""
+    def free_hugepages(self) -> str:
+        """Free out of reserved hugepages of each size on this host, such as 2048kB 6/64.
+
+        Free pages change as VMs start and stop, so they are only reported in
+        this unit's status rather than shared with peers.
+        """
+        return ", ".join(
+            f"{size} {free}/{total}"
+            for size, (total, free) in self.host.hugepages.items()
+            if total
+        )
+
+    def discover(self, kvm_reload_pending: bool = False) -> None:
+        """Determine the virtualisation capabilities of this host, and informs peers.
+
+        Only stable host facts are shared, so that peers aren't informed of
+        every VM start or stop.
+
+        Args:
+            kvm_reload_pending: kvm module options await a reload on this host
+        """
         if self.relation:
+            host = self.host
+
+            def compact(value) -> str:
+                return json.dumps(value, separators=(",", ":"))
+
             self.relation.data[self.model.unit].update(
-                {"supports-kvm": "true" if self.dev_kvm_exists else "false"}
+                {
+                    "supports-kvm": compact(self.dev_kvm_exists),
+                    "cpu-vendor": host.cpu_vendor,
+                    "cpu-model": host.cpu_model,
+                    "virt-flags": compact(host.virt_flags),
+                    "nested-virt": compact(host.nested),
+                    "cores": compact(host.cores),
+                    "cpus": compact(host.cpus),
+                    "numa-nodes": compact(host.numa_nodes),
+                    "hugepages": compact(
+                        {size: total for size, (total, _) in host.hugepages.items()}
+                    ),
+                    "iommu": compact(host.iommu),
+                    "kvm-reload-pending": compact(kvm_reload_pending),
+                    "cpu-manager-policy": host.cpu_manager_policy,
+                    "isolated-cpus": compact(host.isolated_cpus),
+                }
             )
+            self.invalidate()
+
+    @property
+    def deployed_release(self) -> Optional[str]:
+        """Release of the manifests last applied, kept across leadership changes."""
+        if not self.relation:
+            return None
+        return self.relation.data[self.model.app].get("deployed-release") or None
+
+    @deployed_release.setter
+    def deployed_release(self, release: str) -> None:
+        if self.relation and self.model.unit.is_leader():
+            self.relation.data[self.model.app]["deployed-release"] = release
+
+    @property
+    def unit_count(self) -> int:
+        """Number of units in the kubevirts relation."""
+        if self.summary:
+            return self.summary.units
+        try:
+            return len(self._data)
+        except ValidationError:
+            return 0
+
+    @property
+    def supports_hugepages(self) -> bool:
+        """At least one kvm capable peer has reserved hugepages."""
+        if self.summary:
+            return self.summary.hugepages_units > 0
+        try:
+            return any(_has_hugepages(_) for _ in self._data)
+        except ValidationError:
+            return False
+
+    @property
+    def supports_cpu_manager(self) -> bool:
+        """At least one kvm capable peer runs the static cpu manager."""
+        if self.summary:
+            return self.summary.cpu_manager_units > 0
+        try:
+            return any(_has_cpu_manager(_) for _ in self._data)
+        except ValidationError:
+            return False
 
     @property
     def supports_kvm(self) -> Optional[bool]:
         """At least one peer supports kvm."""
-        return any(_.supports_kvm for _ in self._data) if self.is_ready else None
+        if not self.is_ready:
+            return None
+        if self.summary:
+            return self.summary.kvm_units > 0
+        return any(_.supports_kvm for _ in self._data)
@@ -0,0 +1,183 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Pre-pulling of a release's images onto every node ahead of an upgrade."""
+
+import logging
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from httpx import HTTPError
+from lightkube import ApiError, Client
+from lightkube.models.apps_v1 import DaemonSetSpec
+from lightkube.models.core_v1 import (
+    Container,
+    EmptyDirVolumeSource,
+    PodSpec,
+    PodTemplateSpec,
+    Toleration,
+    Volume,
+    VolumeMount,
+)
+from lightkube.models.meta_v1 import LabelSelector, ObjectMeta
+from lightkube.resources.apps_v1 import DaemonSet
+from lightkube.resources.core_v1 import Pod
+from ops.manifests import ManifestClientError
+
+log = logging.getLogger(__name__)
+
+PREPULL_NAME = "kubevirt-prepull"
+# annotation of the DaemonSet with the release whose images it pulls
+RELEASE_ANNOTATION = "kubevirt.charm/prepull-release"
+# static binary of virt-launcher, which KubeVirt runs in container disk images
+# lacking any shell, here keeping each pulled image's container idle
+CONTAINER_DISK_BINARY = "/usr/bin/container-disk"
+BINARY_DIR = "/prepull"
+
+
+def launcher_image(images: Iterable[str]) -> Optional[str]:
+    """The virt-launcher image among a release's images, providing container-disk."""
+    for image in images:
+        name = image.split("@", 1)[0].rsplit("/", 1)[-1].split(":", 1)[0]
+        if name == "virt-launcher":
+            return image
+    return None
+
+
+class PrePuller:
+    """Manages a short-lived DaemonSet running a container of each image.
+
+    The containers only need their images pulled, so a node counts as pulled
+    once the kubelet reports an image ID for every one. Images may not hold a
+    shell, so an init container copies virt-launcher's static container-disk
+    binary to a shared volume, and each container idles running that binary.
+    Containers rather than init containers are used, as an init container
+    failing to start would keep the following images from being pulled.
+
+    Args:
+        client: lightkube client of the cluster
+        namespace: namespace of the DaemonSet
+        patches: manifest patches applied to the DaemonSet, such as ConfigRegistry
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        namespace: str,
+        patches: Iterable[Callable[[DaemonSet], None]] = (),
+    ):
+        self.client = client
+        self.namespace = namespace
+        self.patches = list(patches)
+
+    def _call(self, msg: str, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except (ApiError, HTTPError) as ex:
+            log.exception(msg)
+            raise ManifestClientError(msg, ex) from ex
+
+    def daemonset(self, release: str, images: List[str]) -> DaemonSet:
+        """Build the patched DaemonSet pulling the images of a release onto every node."""
+        labels = {"app": PREPULL_NAME}
+        launcher = launcher_image(images)
+        mount = VolumeMount(name="binary", mountPath=BINARY_DIR)
+        binary = f"{BINARY_DIR}/container-disk"
+        copy_binary = Container(
+            name="binary",
+            image=launcher,
+            imagePullPolicy="IfNotPresent",
+            command=["/usr/bin/cp", CONTAINER_DISK_BINARY, binary],
+            volumeMounts=[mount],
+        )
+        containers = [
+            Container(
+                name=f"image-{idx}",
+                image=image,
+                imagePullPolicy="IfNotPresent",
+                command=[binary, "--copy-path", f"{BINARY_DIR}/image-{idx}"],
+                volumeMounts=[mount],
+            )
+            for idx, image in enumerate(images)
+        ]
+        obj = DaemonSet(
+            metadata=ObjectMeta(
+                name=PREPULL_NAME,
+                namespace=self.namespace,
+                labels=labels,
+                annotations={RELEASE_ANNOTATION: release},
+            ),
+            spec=DaemonSetSpec(
+                selector=LabelSelector(matchLabels=labels),
+                template=PodTemplateSpec(
+                    metadata=ObjectMeta(labels=labels),
+                    spec=PodSpec(
+                        initContainers=[copy_binary],
+                        containers=containers,
+                        volumes=[
+                            Volume(name="binary", emptyDir=EmptyDirVolumeSource())
+                        ],
+                        tolerations=[Toleration(operator="Exists")],
+                        terminationGracePeriodSeconds=0,
+                    ),
+                ),
+            ),
+        )
+        for patch in self.patches:
+            patch(obj)
+        return obj
+
+    def apply(self, release: str, images: List[str]) -> None:
+        """Create or update the pre-pull DaemonSet of a release."""
+        log.info(f"Pre-pulling {len(images)} images of {release}")
+        self._call(
+            "Failed applying the pre-pull DaemonSet",
+            self.client.apply,
+            self.daemonset(release, images),
+            force=True,
+        )
+
+    def progress(self, release: str, images: List[str]) -> Optional[Tuple[int, int]]:
+        """Count the nodes which pulled every image of a release, and the nodes to pull on.
+
+        None until the DaemonSet of the release is observed by its controller.
+        The DaemonSet and its pods are read once each.
+        """
+        daemonset = self._call(
+            "Failed reading the pre-pull DaemonSet",
+            self.client.get,
+            DaemonSet,
+            PREPULL_NAME,
+            namespace=self.namespace,
+        )
+        annotations = daemonset.metadata.annotations or {}
+        status = daemonset.status
+        if (
+            annotations.get(RELEASE_ANNOTATION) != release
+            or not status
+            or (status.observedGeneration or 0) < (daemonset.metadata.generation or 0)
+        ):
+            return None
+        pods = self._call(
+            "Failed listing the pre-pull pods",
+            lambda: list(
+                self.client.list(
+                    Pod, namespace=self.namespace, labels={"app": PREPULL_NAME}
+                )
+            ),
+        )
+        pulled = 0
+        for pod in pods:
+            statuses = (pod.status and pod.status.containerStatuses) or []
+            if len(statuses) == len(images) and all(s.imageID for s in statuses):
+                pulled += 1
+        return pulled, status.desiredNumberScheduled
+
+    def delete(self) -> None:
+        """Remove the pre-pull DaemonSet, if present."""
+        self._call("Failed deleting the pre-pull DaemonSet", self._delete)
+
+    def _delete(self) -> None:
+        try:
+            self.client.delete(DaemonSet, PREPULL_NAME, namespace=self.namespace)
+        except ApiError as ex:
+            if ex.status.code != 404:
+                raise
@@ -0,0 +1,176 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Tiered removal of the resources of a manifest."""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from httpx import HTTPError
+from lightkube import ApiError, Client
+from ops.manifests import HashableResource, ManifestClientError
+
+log = logging.getLogger(__name__)
+
+RBAC_KINDS = frozenset(
+    {"ClusterRole", "ClusterRoleBinding", "Role", "RoleBinding", "ServiceAccount"}
+)
+# kinds removed last, once nothing depends on them
+FOUNDATION_KINDS = frozenset({"CustomResourceDefinition", "Namespace"})
+DEFAULT_WORKERS = 8
+# seconds each tier may take to disappear before its objects are reported stuck
+DEFAULT_TIER_TIMEOUT = 120.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+class TeardownResult(NamedTuple):
+    """Outcome of a teardown."""
+
+    deleted: int
+    stuck: List[str]
+
+
+def teardown_tiers(
+    resources: Iterable[HashableResource],
+) -> List[List[HashableResource]]:
+    """Order resources into tiers deleted one after another.
+
+    Custom resources go first, their finalizers holding them until the
+    operator removed the workloads it created. Then come the operator's own
+    workloads and services, then RBAC, and finally the CRDs and namespaces.
+    """
+    resources = list(resources)
+    custom_kinds = {
+        rsc.resource.spec.names.kind
+        for rsc in resources
+        if rsc.kind == "CustomResourceDefinition"
+    }
+    tiers: List[List[HashableResource]] = [[], [], [], []]
+    for rsc in resources:
+        if rsc.kind in custom_kinds:
+            tiers[0].append(rsc)
+        elif rsc.kind in FOUNDATION_KINDS:
+            tiers[3].append(rsc)
+        elif rsc.kind in RBAC_KINDS:
+            tiers[2].append(rsc)
+        else:
+            tiers[1].append(rsc)
+    return [tier for tier in tiers if tier]
+
+
+def _describe(key: Tuple, obj=None, error: Optional[str] = None) -> str:
+    kind, namespace, name = key
+    described = "/".join(filter(None, (kind.__name__, namespace, name)))
+    finalizers = obj and obj.metadata.finalizers
+    if finalizers:
+        return f"{described} (finalizers: {', '.join(finalizers)})"
+    if error:
+        return f"{described} ({error})"
+    return described
+
+
+class Teardown:
+    """Deletes labelled resources tier by tier, concurrently within a tier.
+
+    Each tier is waited on until its objects are gone or its timeout passes,
+    in which case the remaining objects are reported stuck and the teardown
+    carries on with the next tier rather than blocking the hook.
+
+    Args:
+        client: lightkube client of the cluster
+        labels: labels selecting the objects owned by the manifest
+        workers: deletes in flight within a tier
+        timeout: seconds each tier may take to disappear
+        interval: seconds between checks of the remaining objects
+        clock: monotonic time source
+        sleep: waits between checks
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        labels: Mapping[str, str],
+        workers: int = DEFAULT_WORKERS,
+        timeout: float = DEFAULT_TIER_TIMEOUT,
+        interval: float = DEFAULT_POLL_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.client = client
+        self.labels: Dict = dict(labels)
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+
+    def _live(self, tier: List[HashableResource]) -> Dict[Tuple, object]:
+        """Labelled objects of a tier still present, listing each kind once per namespace.
+
+        Every labelled object of the tier's kinds is included, not only the
+        rendered ones, so objects installed by an earlier release are removed too.
+        """
+        groups: Set[Tuple] = {(rsc.namespace, type(rsc.resource)) for rsc in tier}
+        live = {}
+        for namespace, kind in groups:
+            try:
+                listed = self.client.list(kind, namespace=namespace, labels=self.labels)
+                for obj in listed:
+                    live[(kind, obj.metadata.namespace, obj.metadata.name)] = obj
+            except ApiError as ex:
+                if ex.status.code not in (401, 403):
+                    msg = f"Failed listing {kind.__name__} resources"
+                    log.exception(msg)
+                    raise ManifestClientError(msg, ex) from ex
+                log.warning(f"Ignored unauthorized listing of {kind.__name__}")
+            except HTTPError as ex:
+                msg = f"Failed listing {kind.__name__} resources"
+                log.exception(msg)
+                raise ManifestClientError(msg, ex) from ex
+        return live
+
+    def _delete(self, key: Tuple) -> Optional[str]:
+        """Delete one object, returning why it couldn't be deleted."""
+        kind, namespace, name = key
+        try:
+            self.client.delete(kind, name, namespace=namespace)
+        except ApiError as ex:
+            if ex.status.code == 404:
+                return None
+            return ex.status.message or str(ex)
+        except HTTPError as ex:
+            return str(ex)
+        return None
+
+    def run(self, resources: Iterable[HashableResource]) -> TeardownResult:
+        """Delete the resources tier by tier, reporting the objects left behind."""
+        deleted, stuck = 0, []
+        with ThreadPoolExecutor(self.workers) as pool:
+            for idx, tier in enumerate(teardown_tiers(resources)):
+                live = self._live(tier)
+                log.info(f"Deleting {len(live)} objects of teardown tier {idx}")
+                errors = dict(zip(live, pool.map(self._delete, live)))
+                failed = {key: error for key, error in errors.items() if error}
+                stuck += sorted(_describe(k, error=e) for k, e in failed.items())
+                pending = {k: o for k, o in live.items() if k not in failed}
+                deadline = self.clock() + self.timeout
+                while pending and self.clock() < deadline:
+                    self.sleep(self.interval)
+                    remaining = self._live(tier)
+                    pending = {k: remaining[k] for k in pending if k in remaining}
+                deleted += len(live) - len(failed) - len(pending)
+                stuck += sorted(_describe(k, o) for k, o in pending.items())
+        if stuck:
+            log.warning(f"Teardown left {len(stuck)} objects: {', '.join(stuck)}")
+        return TeardownResult(deleted, stuck)
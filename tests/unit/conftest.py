@@ -1,6 +1,11 @@
 # Copyright 2023 Canonical Ltd.
 # See LICENSE file for licensing details.
+import json
+import threading
+import time
 import unittest.mock as mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 import pytest
 from lightkube import ApiError
@@ -21,3 +26,136 @@ def api_error_klass():
             pass
 
     yield TestApiError
+
+
+class FakeGitHub:
+    """Serves synthetic kubevirt tags and release assets over local http."""
+
+    MANIFEST = """\
+---
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: kubevirt
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: virt-operator
+  namespace: kubevirt
+spec:
+  template:
+    spec:
+      containers:
+      - name: virt-operator
+        image: quay.io/kubevirt/virt-operator:{content}
+        env:
+        - name: OPERATOR_IMAGE
+          value: quay.io/kubevirt/virt-operator:{content}
+"""
+    CR = """\
+---
+apiVersion: kubevirt.io/v1
+kind: KubeVirt
+metadata:
+  name: kubevirt
+  namespace: kubevirt
+spec:
+  configuration:
+    developerConfiguration:
+      featureGates: []
+"""
+
+    def __init__(self, releases: int = 10, latency: float = 0.0, per_page: int = 100):
+        # every patch release of a minor shares its content, so dedupe has work
+        self.tags = [f"v1.{i // 3}.{i % 3}" for i in range(releases)]
+        self.latency = latency
+        self.per_page = per_page
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def content(self, tag: str) -> str:
+        return tag.rsplit(".", 1)[0]
+
+    def _handler(self):
+        github = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                github.requests += 1
+                time.sleep(github.latency)
+                url = urlparse(self.path)
+                if url.path.endswith("/tags"):
+                    self._tags(int(parse_qs(url.query).get("page", ["1"])[0]))
+                elif "/releases/download/" in url.path:
+                    tag, manifest = url.path.split("/")[-2:]
+                    if tag not in github.tags:
+                        return self.send_error(404)
+                    template = github.CR if "cr" in manifest else github.MANIFEST
+                    self._send(template.format(content=github.content(tag)).encode())
+                else:
+                    self.send_error(404)
+
+            def _tags(self, page):
+                start = (page - 1) * github.per_page
+                items = [
+                    {"name": t} for t in github.tags[start : start + github.per_page]
+                ]
+                headers = {}
+                if start + github.per_page < len(github.tags):
+                    next_page = (
+                        f"{github.url}{urlparse(self.path).path}?page={page + 1}"
+                    )
+                    headers["Link"] = f'<{next_page}>; rel="next"'
+                self._send(json.dumps(items).encode(), headers)
+
+            def _send(self, body, headers=None):
+                self.send_response(200)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_github(tmp_path, monkeypatch):
+    """Point update.py at a local fake github and a temporary manifest tree.
+
+    Call the yielded factory with the number of releases and request latency.
+    """
+    from upstream import update
+
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setattr(update, "FILEDIR", tmp_path)
+    (tmp_path / "operator" / "manifests").mkdir(parents=True)
+    servers = []
+
+    def factory(releases=10, latency=0.0, per_page=100):
+        github = FakeGitHub(releases, latency, per_page).__enter__()
+        servers.append(github)
+        monkeypatch.setattr(update, "GH_TAGS", github.url + "/repos/{repo}/tags")
+        monkeypatch.setattr(
+            update, "GH_RAW", github.url + "/{repo}/{path}/{rel}/{manifest}"
+        )
+        monkeypatch.setitem(update.SOURCES["operator"], "minimum", "v1.0.0")
+        return github
+
+    yield factory
+    for github in servers:
+        github.__exit__()
@@ -4,6 +4,7 @@
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
 
+import contextlib
 import unittest.mock as mock
 
 import ops.testing
@@ -52,3 +53,93 @@ def test_update_status_with_conditions(harness_installed):
         harness_installed.charm.unit.status.message
         == "KubeVirt/kubevirt/kubevirt is not Tested"
     )
+
+
+def test_config_sources_read_once_per_hook(harness_installed):
+    charm = harness_installed.charm
+    charm.kube_operator.invalidate()
+    sources = {
+        "kube_control.is_ready": (type(charm.kube_control), "is_ready", True),
+        "kube_virt.is_ready": (type(charm.kube_virt), "is_ready", True),
+        "kube_virt.supports_kvm": (type(charm.kube_virt), "supports_kvm", True),
+        "charm_config.available_data": (
+            type(charm.charm_config),
+            "available_data",
+            {"pvc-tolerate-less-space-up-to-percent": 10},
+        ),
+    }
+    mocks = {}
+    with contextlib.ExitStack() as stack:
+        for name, (klass, attr, value) in sources.items():
+            mocks[name] = stack.enter_context(
+                mock.patch.object(
+                    klass, attr, new_callable=mock.PropertyMock, return_value=value
+                )
+            )
+        mocks["kube_control.get_registry_location"] = stack.enter_context(
+            mock.patch.object(
+                charm.kube_control, "get_registry_location", return_value="my.reg"
+            )
+        )
+        for check in ("_check_kube_control", "_check_kube_virts", "_update_status"):
+            stack.enter_context(mock.patch.object(charm, check, return_value=True))
+        install = stack.enter_context(
+            mock.patch.object(charm, "_install_manifests", return_value=True)
+        )
+        charm._merge_config(mock.MagicMock())
+
+    install.assert_called_once()
+    for name, source in mocks.items():
+        assert source.call_count == 1, f"{name} read {source.call_count} times"
+
+
+def test_reconcile_bursts_coalesced(harness_installed):
+    charm = harness_installed.charm
+    charm.stored.installed = True
+    charm.stored.reconciles_executed = charm.stored.reconciles_skipped = 0
+    charm._attempted = None
+    with contextlib.ExitStack() as stack:
+        checks = {
+            name: stack.enter_context(mock.patch.object(charm, name, return_value=True))
+            for name in ("_check_kube_control", "_check_kube_virts", "_update_status")
+        }
+        evaluate = stack.enter_context(
+            mock.patch.object(charm.kube_operator, "evaluate", return_value=None)
+        )
+        install = stack.enter_context(
+            mock.patch.object(charm, "_install_manifests", return_value=True)
+        )
+        for _ in range(5):
+            charm._merge_config(mock.MagicMock())
+        assert install.call_count == evaluate.call_count == 1
+        # skipped reconciles restore the status without querying the cluster
+        assert checks["_update_status"].call_count == 1
+        charm.unit.status = ops.ActiveStatus("cached")
+        charm._merge_config(mock.MagicMock())
+        assert charm.unit.status == ops.ActiveStatus("cached")
+
+        # a later hook with unchanged inputs skips, a changed input reconciles
+        charm._attempted = None
+        charm._merge_config(mock.MagicMock())
+        assert install.call_count == 1
+        harness_installed.update_config({"eviction-strategy": "LiveMigrate"})
+        assert install.call_count == 2
+
+        # a broken relation always reconciles
+        charm._merge_config(mock.MagicMock(spec=ops.RelationBrokenEvent))
+        assert evaluate.call_count == 3
+
+    event = mock.MagicMock()
+    charm._reconcile_stats(event)
+    results = event.set_results.call_args.args[0]
+    assert (results["executed"], results["skipped"]) == (3, 6)
+    assert results["reconciled"] == charm._reconcile_fingerprint()
+
+
+def test_reconcile_fingerprint_waits_for_readiness(harness_installed):
+    charm = harness_installed.charm
+    with mock.patch.object(charm, "_check_kube_control", return_value=False):
+        with mock.patch.object(charm, "_reconcile_fingerprint") as fingerprinted:
+            charm._merge_config(mock.MagicMock())
+    fingerprinted.assert_not_called()
+    assert charm.stored.reconciled is None
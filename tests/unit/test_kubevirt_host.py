@@ -0,0 +1,223 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import json
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+
+from charm import CharmKubeVirtCharm
+from kubevirt_host import (
+    HostCapabilities,
+    parse_hugepages,
+    parse_ksm,
+    probe,
+    tune_kvm,
+    tune_memory,
+)
+
+CPUINFO = """\
+processor\t: {cpu}
+vendor_id\t: GenuineIntel
+model name\t: Intel(R) Xeon(R) Gold 6230 CPU @ 2.10GHz
+physical id\t: 0
+core id\t\t: {core}
+flags\t\t: fpu vme de pse vmx ssse3 ept vpid
+"""
+
+
+@pytest.fixture
+def host(tmp_path):
+    proc, sys = tmp_path / "proc", tmp_path / "sys"
+    proc.mkdir()
+    # 2 hyperthreads on each of 2 cores
+    (proc / "cpuinfo").write_text(
+        "\n".join(CPUINFO.format(cpu=cpu, core=cpu // 2) for cpu in range(4))
+    )
+    nested = sys / "module/kvm_intel/parameters"
+    nested.mkdir(parents=True)
+    (nested / "nested").write_text("Y\n")
+    for node in range(2):
+        (sys / f"devices/system/node/node{node}").mkdir(parents=True)
+    (sys / "devices/system/node/possible").write_text("0-1\n")
+    for size, total, free in (("2048kB", 512, 256), ("1048576kB", 0, 0)):
+        pages = sys / f"kernel/mm/hugepages/hugepages-{size}"
+        pages.mkdir(parents=True)
+        (pages / "nr_hugepages").write_text(f"{total}\n")
+        (pages / "free_hugepages").write_text(f"{free}\n")
+    for param in ("run", "pages_to_scan"):
+        (sys / "kernel/mm/ksm").mkdir(parents=True, exist_ok=True)
+        (sys / f"kernel/mm/ksm/{param}").write_text("0\n")
+    (sys / "kernel/mm/transparent_hugepage").mkdir(parents=True)
+    (sys / "kernel/mm/transparent_hugepage/enabled").write_text("[always] never\n")
+    (sys / "class/iommu/dmar0").mkdir(parents=True)
+    (tmp_path / "dev").mkdir()
+    (tmp_path / "dev/kvm").touch()
+    return tmp_path
+
+
+def test_probe(host):
+    caps = probe(host)
+    assert caps == HostCapabilities(
+        cpu_vendor="GenuineIntel",
+        cpu_model="Intel(R) Xeon(R) Gold 6230 CPU @ 2.10GHz",
+        virt_flags=["ept", "vmx"],
+        nested=True,
+        cores=2,
+        cpus=4,
+        numa_nodes=2,
+        hugepages={"1048576kB": (0, 0), "2048kB": (512, 256)},
+        iommu=True,
+    )
+    assert caps.slat
+
+
+def test_probe_bare_host(tmp_path):
+    caps = probe(tmp_path)
+    assert caps == HostCapabilities()
+    assert not caps.slat
+
+
+def test_discover_publishes_capabilities(host):
+    harness = ops.testing.Harness(CharmKubeVirtCharm)
+    rel_id = harness.add_relation("kubevirts", "kubevirt")
+    harness.begin()
+    peer = harness.charm.kube_virt
+    peer.root = host
+    try:
+        peer.discover()
+        data = harness.get_relation_data(rel_id, "kubevirt/0")
+        assert data["supports-kvm"] == "true"
+        # free pages change with every VM, so only the reservations are shared
+        assert data["hugepages"] == '{"1048576kB":0,"2048kB":512}'
+        assert json.loads(data["virt-flags"]) == ["ept", "vmx"]
+        (unit,) = peer._data
+        assert unit.supports_kvm and unit.nested and unit.iommu
+        assert (unit.cores, unit.cpus, unit.numa_nodes) == (2, 4, 2)
+        assert unit.hugepages == {"1048576kB": 0, "2048kB": 512}
+        assert peer.free_hugepages() == "2048kB 256/512"
+
+        # a VM taking hugepages leaves the shared data untouched
+        free = host / "sys/kernel/mm/hugepages/hugepages-2048kB/free_hugepages"
+        free.write_text("128\n")
+        peer.discover()
+        shared = harness.get_relation_data(rel_id, "kubevirt/0")["hugepages"]
+        assert shared == '{"1048576kB":0,"2048kB":512}'
+        assert peer.free_hugepages() == "2048kB 128/512"
+    finally:
+        harness.cleanup()
+
+
+def test_tune_memory(host):
+    tune_memory(
+        host,
+        parse_hugepages("2M=1024 1G=2"),
+        parse_ksm("run=1 pages_to_scan=500"),
+        "madvise",
+    )
+    sys = host / "sys/kernel/mm"
+    assert (sys / "hugepages/hugepages-2048kB/nr_hugepages").read_text() == "1024\n"
+    assert (sys / "hugepages/hugepages-1048576kB/nr_hugepages").read_text() == "2\n"
+    assert (sys / "ksm/run").read_text() == "1\n"
+    assert (sys / "transparent_hugepage/enabled").read_text() == "madvise\n"
+    assert (host / "etc/sysctl.d/60-kubevirt.conf").read_text().splitlines()[1:] == [
+        "vm.nr_hugepages = 1024"
+    ]
+    assert (host / "etc/tmpfiles.d/kubevirt.conf").read_text().splitlines()[1:] == [
+        "w /sys/kernel/mm/hugepages/hugepages-1048576kB/nr_hugepages - - - - 2",
+        "w /sys/kernel/mm/ksm/run - - - - 1",
+        "w /sys/kernel/mm/ksm/pages_to_scan - - - - 500",
+        "w /sys/kernel/mm/transparent_hugepage/enabled - - - - madvise",
+    ]
+
+    tune_memory(host, {}, {}, "")
+    assert not (host / "etc/sysctl.d/60-kubevirt.conf").exists()
+    assert not (host / "etc/tmpfiles.d/kubevirt.conf").exists()
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"hugepages": "4M=2"}, "hugepages size 4M is not one of 2M, 1G"),
+        ({"hugepages": "2M=many"}, "isn't formatted as key=integer"),
+        ({"ksm": "speed=1"}, "ksm speed is not one of"),
+        ({"transparent-hugepages": "sometimes"}, "transparent-hugepages sometimes"),
+    ],
+)
+def test_memory_tuning_config_validated(config, message):
+    harness = ops.testing.Harness(CharmKubeVirtCharm)
+    harness.update_config(config)
+    harness.begin()
+    try:
+        assert message in harness.charm.charm_config.evaluate()
+    finally:
+        harness.cleanup()
+
+
+def test_hugepages_reported_to_leader(host):
+    harness = ops.testing.Harness(CharmKubeVirtCharm)
+    rel_id = harness.add_relation("kubevirts", "kubevirt")
+    harness.set_leader(True)
+    harness.begin()
+    harness.charm.stored.has_kvm = True
+    peer = harness.charm.kube_virt
+    peer.root = host
+    try:
+        (host / "sys/kernel/mm/hugepages/hugepages-2048kB/nr_hugepages").write_text(
+            "0\n"
+        )
+        peer.discover()
+        assert not peer.supports_hugepages
+
+        harness.update_config({"hugepages": "2M=64"})
+        harness.charm._tune_host()
+        assert harness.get_relation_data(rel_id, "kubevirt/0")["hugepages"].startswith(
+            '{"1048576kB":0,"2048kB":64}'
+        )
+        peer.publish_summary()
+        assert harness.get_relation_data(rel_id, "kubevirt")["hugepages-units"] == "1"
+    finally:
+        harness.cleanup()
+
+
+def test_tune_kvm_reloads_without_vms(host):
+    (host / "sys/module/kvm/parameters").mkdir(parents=True)
+    refcnt = host / "sys/module/kvm_intel/refcnt"
+    refcnt.write_text("2\n")
+    with mock.patch("kubevirt_host.subprocess.check_call") as check_call:
+        assert tune_kvm(host, nested=True, halt_poll_ns=None)
+        check_call.assert_not_called()
+
+        assert not tune_kvm(host, nested=False, halt_poll_ns=50000)
+        check_call.assert_not_called()
+        assert (host / "etc/modprobe.d/kubevirt-kvm.conf").read_text().splitlines()[
+            1:
+        ] == ["options kvm_intel nested=0", "options kvm halt_poll_ns=50000"]
+        assert (host / "sys/module/kvm/parameters/halt_poll_ns").read_text() == (
+            "50000\n"
+        )
+
+        refcnt.write_text("0\n")
+        assert tune_kvm(host, nested=False, halt_poll_ns=50000)
+        assert check_call.call_args_list == [
+            mock.call(["modprobe", "-r", "kvm_intel"]),
+            mock.call(["modprobe", "kvm_intel"]),
+        ]
+
+    tune_kvm(host, nested=None, halt_poll_ns=None)
+    assert not (host / "etc/modprobe.d/kubevirt-kvm.conf").exists()
+
+
+def test_probe_cpu_manager(host):
+    (host / "sys/devices/system/cpu").mkdir(parents=True)
+    (host / "sys/devices/system/cpu/isolated").write_text("2-5,8\n")
+    args = host / "var/snap/kubelet/current/args"
+    args.parent.mkdir(parents=True)
+    args.write_text('--v=0\n--cpu-manager-policy="static"\n')
+    caps = probe(host)
+    assert (caps.cpu_manager_policy, caps.isolated_cpus) == ("static", 5)
+
+    config = host / "root/cdk/kubelet/config.yaml"
+    config.parent.mkdir(parents=True)
+    config.write_text("kind: KubeletConfiguration\ncpuManagerPolicy: none\n")
+    assert probe(host).cpu_manager_policy == "none"
@@ -0,0 +1,455 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import json
+import unittest.mock as mock
+from copy import deepcopy
+from hashlib import sha256
+
+import pytest
+import yaml
+from lightkube import codecs
+from lightkube.resources.core_v1 import Node
+
+from kubevirt_manifests import (
+    OPERATOR_COMPONENTS,
+    PERFORMANCE_PROFILES,
+    KubeVirtOperator,
+    control_plane_sizing,
+    fingerprint,
+    pin_image,
+)
+
+
+@pytest.fixture
+def operator():
+    charm = mock.MagicMock()
+    charm_config = mock.MagicMock()
+    charm_config.available_data = {
+        "operator-release": "v0.58.0",
+        "pvc-tolerate-less-space-up-to-percent": 10,
+    }
+    kube_control = mock.MagicMock(is_ready=False)
+    kube_virts = mock.MagicMock(
+        is_ready=True,
+        supports_kvm=True,
+        supports_hugepages=False,
+        supports_cpu_manager=False,
+        unit_count=3,
+    )
+    yield KubeVirtOperator(charm, charm_config, kube_control, kube_virts)
+
+
+def test_selected_kinds_loads_indexed_documents(operator):
+    with mock.patch("yaml.safe_load_all") as full_load:
+        with operator.selected_kinds(["kubevirt", "Deployment"]):
+            selected = {str(rsc) for rsc in operator.resources}
+    full_load.assert_not_called()
+    everything = {str(rsc) for rsc in operator.resources}
+    assert selected == {
+        "KubeVirt/kubevirt/kubevirt",
+        "Deployment/kubevirt/virt-operator",
+    }
+    assert selected < everything
+
+
+def test_plan_upgrade(operator):
+    plan = operator.plan_upgrade("v0.57.1")
+    assert (plan.current, plan.target) == ("v0.58.0", "v0.57.1")
+    assert {
+        "spec.template.spec.containers[0].env[0].value",
+        "spec.template.spec.containers[0].image",
+    } <= set(plan.changed["Deployment/kubevirt/virt-operator"])
+    assert plan.unchanged > 0
+
+    same = operator.plan_upgrade("v0.58.0")
+    assert not (same.added or same.removed or same.changed)
+
+
+def test_fingerprint_is_canonical():
+    assert fingerprint({"a": 1, "b": [True, None]}) == fingerprint(
+        {"b": [True, None], "a": 1}
+    )
+    assert fingerprint({"a": 1}) != fingerprint({"a": True})
+    assert fingerprint({"a": 1}) != fingerprint({"a": 1.0})
+    assert fingerprint({"a": "1"}) != fingerprint({"a": 1})
+    assert fingerprint({"a": 1}) == "1ae70e64eda7b866341528cd048dad86"
+
+
+def test_hash_covers_release_manifests(operator):
+    first = operator.hash()
+    assert operator.hash() == first
+    with operator.selected_release("v0.57.1"):
+        assert operator.hash() != first
+
+
+def test_resources_rendered_once_per_config(operator):
+    first = {str(rsc): rsc.resource for rsc in operator.resources}
+    with mock.patch.object(operator, "_render", wraps=operator._render) as render:
+        assert {str(rsc) for rsc in operator.resources} == first.keys()
+        render.assert_not_called()
+
+        operator.charm_config.available_data = {
+            **operator.charm_config.available_data,
+            "pvc-tolerate-less-space-up-to-percent": 20,
+        }
+        operator.invalidate()
+        rendered = {str(rsc): rsc.resource for rsc in operator.resources}
+        assert render.call_count == len(first)
+
+    kubevirt = rendered["KubeVirt/kubevirt/kubevirt"]
+    dev_config = kubevirt.spec["configuration"]["developerConfiguration"]
+    assert dev_config["pvcTolerateLessSpaceUpToPercent"] == 20
+
+
+def test_manifests_parsed_once_per_hook(operator):
+    indexed = mock.patch.object(operator, "_indexed_load")
+    with mock.patch("yaml.safe_load_all", wraps=yaml.safe_load_all) as parse, indexed:
+        assert operator.evaluate() is None
+        resources = operator.resources
+        operator._indexed_load.assert_not_called()
+    manifests = list((operator.manifest_path / "v0.58.0").glob("*.yaml"))
+    assert parse.call_count == len(manifests)
+    assert any(rsc.kind == "KubeVirt" for rsc in resources)
+
+
+def test_drift_lists_each_kind_once(operator, lk_client):
+    with operator.selected_kinds(["Deployment", "KubeVirt"]):
+        expected = [rsc.resource for rsc in operator.resources]
+
+        def listing(kind, namespace=None, labels=None):
+            for rsc in expected:
+                if isinstance(rsc, kind):
+                    live = deepcopy(rsc.to_dict())
+                    live["metadata"]["uid"] = "server-assigned"
+                    live["status"] = {"phase": "Deployed"}
+                    if live["kind"] == "Deployment":
+                        live["spec"]["replicas"] = 1
+                    yield codecs.from_dict(live)
+
+        lk_client.list.side_effect = listing
+        drifted = operator.drift()
+
+    assert {str(rsc): fields for rsc, fields in drifted.items()} == {
+        "Deployment/kubevirt/virt-operator": ["spec.replicas"]
+    }
+    listed = [c.args[0].__name__ for c in lk_client.list.call_args_list]
+    assert listed.count("Deployment") == listed.count("KubeVirt") == 1
+
+
+def _kubevirt(operator):
+    (kubevirt,) = (rsc.resource for rsc in operator.resources if rsc.kind == "KubeVirt")
+    return kubevirt.spec["configuration"]
+
+
+def test_performance_profiles_supported_by_every_release(operator):
+    for release in operator.releases:
+        for profile in PERFORMANCE_PROFILES:
+            operator.charm_config.available_data["performance-profile"] = profile
+            with operator.selected_release(release):
+                assert operator.evaluate() is None, (release, profile)
+
+
+def test_performance_profile_rendered(operator):
+    operator.charm_config.available_data["performance-profile"] = "low-latency"
+    configuration = _kubevirt(operator)
+    assert configuration["cpuModel"] == "host-passthrough"
+    assert configuration["developerConfiguration"]["featureGates"] == []
+
+    operator.kube_virts.supports_hugepages = True
+    operator.kube_virts.supports_cpu_manager = True
+    operator.invalidate()
+    configuration = _kubevirt(operator)
+    assert configuration["developerConfiguration"]["featureGates"] == [
+        "NUMA",
+        "CPUManager",
+    ]
+    assert configuration["developerConfiguration"]["useEmulation"] is False
+    assert configuration["network"]["defaultNetworkInterface"] == "bridge"
+
+
+def test_performance_profile_validated(operator):
+    operator.charm_config.available_data["performance-profile"] = "fastest"
+    assert "fastest is not one of" in operator.evaluate()
+
+    profile = {"developerConfiguration": {"turbo": True}, "cpuModel": "host-model"}
+    with mock.patch.dict(PERFORMANCE_PROFILES, {"fastest": profile}):
+        assert operator.evaluate() == (
+            "performance-profile fastest unsupported by v0.58.0: "
+            "configuration.developerConfiguration.turbo"
+        )
+
+
+def test_migration_settings_rendered(operator):
+    assert "migrations" not in _kubevirt(operator)
+    operator.charm_config.available_data.update(
+        {
+            "migration-parallel-per-cluster": 20,
+            "migration-parallel-outbound-per-node": 4,
+            "migration-bandwidth": "1Gi",
+            "migration-allow-auto-converge": True,
+            "migration-network": "migration-net",
+        }
+    )
+    first = operator.hash()
+    operator.invalidate()
+    assert operator.evaluate() is None
+    assert operator.hash() != first
+    assert _kubevirt(operator)["migrations"] == {
+        "parallelMigrationsPerCluster": 20,
+        "parallelOutboundMigrationsPerNode": 4,
+        "bandwidthPerMigration": "1Gi",
+        "allowAutoConverge": True,
+        "network": "migration-net",
+    }
+
+
+@pytest.mark.parametrize(
+    "key, value, message",
+    [
+        ("migration-parallel-per-cluster", 0, "must be a positive integer"),
+        ("migration-progress-timeout", -1, "must be a positive integer"),
+        ("migration-bandwidth", "fast", "is not a quantity"),
+        ("migration-bandwidth", "1K", "is not a quantity"),
+        ("migration-bandwidth", "-1Mi", "is not a quantity"),
+    ],
+)
+def test_migration_settings_validated(operator, key, value, message):
+    operator.charm_config.available_data[key] = value
+    assert message in operator.evaluate()
+
+
+@pytest.mark.parametrize("bandwidth", ["1k", "100u", "1e3", "64Mi", "0"])
+def test_migration_bandwidth_quantities(operator, bandwidth):
+    operator.charm_config.available_data["migration-bandwidth"] = bandwidth
+    assert operator.evaluate() is None
+
+
+@pytest.mark.parametrize(
+    "units, sizing",
+    [
+        (3, ("", 0)),
+        (50, ("controller=400/800 webhook=400/800", 3)),
+        (1000, ("controller=800/1600 webhook=800/1600", 5)),
+    ],
+)
+def test_control_plane_sizing(units, sizing):
+    assert control_plane_sizing(units) == sizing
+
+
+def test_control_plane_rendered(operator):
+    operator.charm_config.available_data.update(
+        {"rest-client-rate-limits": "auto", "infra-replicas": 0}
+    )
+    kubevirt = _kubevirt(operator)
+    assert "controllerConfiguration" not in kubevirt
+
+    operator.kube_virts.unit_count = 60
+    operator.charm_config.available_data["infra-node-selector"] = "infra=true"
+    operator.invalidate()
+    assert operator.evaluate() is None
+    (obj,) = (rsc.resource for rsc in operator.resources if rsc.kind == "KubeVirt")
+    bucket = {"tokenBucketRateLimiter": {"qps": 400, "burst": 800}}
+    assert obj.spec["configuration"]["controllerConfiguration"] == {
+        "restClient": {"rateLimiter": bucket}
+    }
+    assert "handlerConfiguration" not in obj.spec["configuration"]
+    assert obj.spec["infra"] == {
+        "replicas": 3,
+        "nodePlacement": {"nodeSelector": {"infra": "true"}},
+    }
+    assert operator.control_plane == {
+        "rest-client-rate-limits": "controller=400/800 webhook=400/800",
+        "infra-replicas": "3",
+    }
+
+
+@pytest.mark.parametrize(
+    "key, value, message",
+    [
+        ("rest-client-rate-limits", "scheduler=1/2", "unknown component"),
+        ("rest-client-rate-limits", "handler=fast", "component=qps/burst"),
+        ("infra-node-selector", "infra", "key=value"),
+        ("infra-replicas", -1, "must not be negative"),
+    ],
+)
+def test_control_plane_validated(operator, key, value, message):
+    operator.charm_config.available_data[key] = value
+    assert message in operator.evaluate()
+
+
+def test_component_resources_rendered(operator):
+    operator.charm_config.available_data["component-resources"] = """
+virt-handler:
+  requests: {cpu: 500m, memory: 512Mi}
+  limits: {cpu: 2}
+  priority-class: kubevirt-cluster-critical
+"""
+    assert operator.evaluate() is None
+    (obj,) = (rsc.resource for rsc in operator.resources if rsc.kind == "KubeVirt")
+    (patch,) = obj.spec["customizeComponents"]["patches"]
+    assert (patch["resourceName"], patch["resourceType"], patch["type"]) == (
+        "virt-handler",
+        "DaemonSet",
+        "strategic",
+    )
+    assert json.loads(patch["patch"]) == {
+        "spec": {
+            "template": {
+                "spec": {
+                    "priorityClassName": "kubevirt-cluster-critical",
+                    "containers": [
+                        {
+                            "name": "virt-handler",
+                            "resources": {
+                                "requests": {"cpu": "500m", "memory": "512Mi"},
+                                "limits": {"cpu": "2"},
+                            },
+                        }
+                    ],
+                }
+            }
+        }
+    }
+
+
+@pytest.mark.parametrize(
+    "value, message",
+    [
+        ("[virt-handler]", "must be a mapping"),
+        ("virt-launcher: {}", "unknown component 'virt-launcher'"),
+        ("virt-api: {requests: {gpu: 1}}", "unexpected 'gpu'"),
+        ("virt-api: {limits: {memory: lots}}", "isn't a quantity"),
+        ("virt-handler: {requests: {cpu: 500K}}", "isn't a quantity"),
+    ],
+)
+def test_component_resources_validated(operator, value, message):
+    operator.charm_config.available_data["component-resources"] = value
+    assert message in operator.evaluate()
+
+
+@pytest.mark.parametrize("cpu", ["500k", "1e3", "250m", "2"])
+def test_component_resources_quantities(operator, cpu):
+    operator.charm_config.available_data["component-resources"] = (
+        f"virt-handler: {{requests: {{cpu: {cpu}}}}}"
+    )
+    assert operator.evaluate() is None
+
+
+def test_cpu_manager_gate_from_peers(operator, lk_client):
+    operator.kube_virts.supports_cpu_manager = True
+    assert _kubevirt(operator)["developerConfiguration"]["featureGates"] == [
+        "CPUManager"
+    ]
+    # the gate is decided from the peers' kubelet facts, without listing nodes
+    assert not [c for c in lk_client.list.call_args_list if c.args[0] is Node]
+
+    operator.kube_virts.supports_cpu_manager = False
+    operator.invalidate()
+    assert _kubevirt(operator)["developerConfiguration"]["featureGates"] == []
+
+
+def test_workload_strategies_rendered(operator):
+    operator.charm_config.available_data.update(
+        {
+            "eviction-strategy": "LiveMigrate",
+            "workload-update-methods": "LiveMigrate Evict",
+            "workload-update-batch-eviction-interval": "1m30s",
+        }
+    )
+    assert operator.evaluate() is None
+    (obj,) = (rsc.resource for rsc in operator.resources if rsc.kind == "KubeVirt")
+    assert obj.spec["configuration"]["evictionStrategy"] == "LiveMigrate"
+    assert obj.spec["workloadUpdateStrategy"] == {
+        "workloadUpdateMethods": ["LiveMigrate", "Evict"],
+        "batchEvictionInterval": "1m30s",
+    }
+
+    with operator.selected_release("v0.48.1"):
+        assert operator.evaluate() == (
+            "workload strategies unsupported by v0.48.1: configuration.evictionStrategy"
+        )
+
+
+@pytest.mark.parametrize(
+    "key, value, message",
+    [
+        ("eviction-strategy", "Migrate", "is not one of None, LiveMigrate"),
+        ("workload-update-methods", "LiveMigrate Reboot", "Reboot is not one of"),
+        ("workload-update-batch-eviction-size", 0, "must be positive"),
+        ("workload-update-batch-eviction-interval", "soon", "is not a duration"),
+    ],
+)
+def test_workload_strategies_validated(operator, key, value, message):
+    operator.charm_config.available_data[key] = value
+    assert message in operator.evaluate()
+
+
+@pytest.mark.parametrize("registry", ["my.registry", "rocks.canonical.com:443/cdk"])
+def test_pinned_digests_rendered_after_registry(operator, registry):
+    operator.charm_config.available_data["image-registry"] = registry
+    digests = {
+        f"kubevirt/{name}:v0.58.0": f"sha256:{name}"
+        for name in ("virt-operator", *OPERATOR_COMPONENTS)
+    }
+    with mock.patch.object(operator, "image_digests", return_value=digests):
+        (deployment,) = (
+            rsc.resource for rsc in operator.resources if rsc.kind == "Deployment"
+        )
+    (container,) = deployment.spec.template.spec.containers
+    assert container.image == f"{registry}/kubevirt/virt-operator@sha256:virt-operator"
+    env = {e.name: e.value for e in container.env}
+    assert env["OPERATOR_IMAGE"] == "quay.io/kubevirt/virt-operator:v0.58.0"
+    assert env["VIRT_HANDLER_SHASUM"] == "sha256:virt-handler"
+    assert env["VIRT_LAUNCHER_SHASUM"] == "sha256:virt-launcher"
+
+
+def test_pin_image():
+    digests = {"kubevirt/virt-api:v1": "sha256:a"}
+    assert pin_image("my.reg:5000/kubevirt/virt-api:v1", digests) == (
+        "my.reg:5000/kubevirt/virt-api@sha256:a"
+    )
+    assert pin_image("rocks.canonical.com:443/cdk/kubevirt/virt-api:v1", digests) == (
+        "rocks.canonical.com:443/cdk/kubevirt/virt-api@sha256:a"
+    )
+    assert pin_image("quay.io/kubevirt/virt-api:v2", digests) == (
+        "quay.io/kubevirt/virt-api:v2"
+    )
+    assert pin_image("quay.io/kubevirt/virt-api@sha256:b", digests) == (
+        "quay.io/kubevirt/virt-api@sha256:b"
+    )
+
+
+def test_stale_index_parses_full_manifest(operator, tmp_path):
+    release = tmp_path / "v0.58.0"
+    release.mkdir()
+    source = operator.manifest_path / "v0.58.0"
+    (release / "index.json").write_text((source / "index.json").read_text())
+    for manifest in source.glob("*.yaml"):
+        # shifting every document leaves the indexed offsets pointing mid-document
+        (release / manifest.name).write_text("# edited\n" + manifest.read_text())
+    everything = {str(rsc) for rsc in operator.resources}
+    operator.manifest_path = tmp_path
+    with operator.selected_kinds(["Deployment"]):
+        selected = {str(rsc) for rsc in operator.resources}
+    # like an unindexed release, the full parse loads every resource
+    assert selected == everything
+
+
+def test_stale_index_digests_file_contents(operator, tmp_path):
+    release = tmp_path / "v0.58.0"
+    release.mkdir()
+    source = operator.manifest_path / "v0.58.0"
+    (release / "index.json").write_text((source / "index.json").read_text())
+    for manifest in source.glob("*.yaml"):
+        (release / manifest.name).write_text(manifest.read_text())
+    indexed, fingerprint = operator.manifest_digests(), operator.hash()
+    operator.manifest_path = tmp_path
+    assert operator.manifest_digests() == indexed
+
+    (manifest,) = list(release.glob("*.yaml"))[:1]
+    manifest.write_text(manifest.read_text() + "# refreshed\n")
+    operator._index_current.cache_clear()
+    digests = operator.manifest_digests()
+    assert digests[manifest.name] == sha256(manifest.read_bytes()).hexdigest()
+    assert digests[manifest.name] != indexed[manifest.name]
+    assert operator.hash() != fingerprint
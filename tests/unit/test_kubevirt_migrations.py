@@ -0,0 +1,279 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import itertools
+import threading
+import time
+from collections import Counter
+
+import ops.testing
+import pytest
+from lightkube.resources.core_v1 import Node
+
+from charm import CharmKubeVirtCharm
+from kubevirt_migrations import (
+    MIGRATION_LABEL,
+    NODE_LABEL,
+    Migrator,
+    VirtualMachineInstance,
+    VirtualMachineInstanceMigration,
+    VMILoad,
+    VMIRef,
+    parse_quantity,
+    plan_rebalance,
+)
+
+
+def _vmi(name, node, migratable=True):
+    status = "True" if migratable else "False"
+    return VirtualMachineInstance(
+        metadata={
+            "name": name,
+            "namespace": "default",
+            "labels": {NODE_LABEL: node},
+        },
+        status={"conditions": [{"type": "LiveMigratable", "status": status}]},
+    )
+
+
+class FakeCluster:
+    """Completes the oldest in-flight migration on each watch event."""
+
+    def __init__(self, vmis, fail=(), stall=()):
+        self.vmis = vmis
+        self.fail = set(fail)
+        self.stall = set(stall)
+        self.names = (f"migration-{i}" for i in itertools.count())
+        self.in_flight = {}
+        self.leaving = Counter()
+        self.peak = Counter()
+        self.watches = 0
+        self.patched = []
+
+    def list(self, resource, namespace=None, labels=None):
+        if resource is not VirtualMachineInstance:
+            return []
+        assert namespace == "*"
+        return [v for v in self.vmis if v.metadata.labels == labels]
+
+    def patch(self, resource, name, obj):
+        assert resource is Node
+        self.patched.append((name, obj))
+
+    def create(self, migration):
+        vmi = next(v for v in self.vmis if v.metadata.name == migration.spec["vmiName"])
+        node = vmi.metadata.labels[NODE_LABEL]
+        self.leaving[node] += 1
+        self.peak["cluster"] = max(self.peak["cluster"], len(self.in_flight) + 1)
+        self.peak["node"] = max(self.peak["node"], self.leaving[node])
+        name = next(self.names)
+        migration.metadata.name = name
+        self.in_flight[name] = (migration, node)
+        return migration
+
+    def watch(self, resource, namespace=None, labels=None):
+        assert resource is VirtualMachineInstanceMigration
+        assert labels == {MIGRATION_LABEL: "drain"}
+        self.watches += 1
+        while self.in_flight:
+            name = next(iter(self.in_flight))
+            migration, node = self.in_flight.pop(name)
+            self.leaving[node] -= 1
+            vmi = migration.spec["vmiName"]
+            phases = ["Running", "Failed" if vmi in self.fail else "Succeeded"]
+            for phase in phases[: 1 if vmi in self.stall else 2]:
+                yield (
+                    "MODIFIED",
+                    VirtualMachineInstanceMigration(
+                        metadata=migration.metadata,
+                        spec=migration.spec,
+                        status={"phase": phase},
+                    ),
+                )
+        if self.stall:
+            # an idle watch blocks until the apiserver has another event
+            threading.Event().wait(30)
+
+
+def test_migrate_bounded_batches():
+    vmis = [
+        _vmi(f"vm-{node}-{idx}", f"node-{node}")
+        for node in range(3)
+        for idx in range(30)
+    ]
+    cluster = FakeCluster(vmis, fail={"vm-1-3"})
+    clock = itertools.count()
+    migrator = Migrator(cluster, per_cluster=5, per_node=2, clock=lambda: next(clock))
+    migratable, pinned = migrator.vmis_on(["node-0", "node-1", "node-2"])
+    assert len(migratable) == 90 and not pinned
+
+    results = migrator.migrate(migratable)
+    assert len(results) == 90
+    assert cluster.watches == 1
+    assert cluster.peak == {"cluster": 5, "node": 2}
+    (failed,) = [r for r in results if r.phase != "Succeeded"]
+    assert failed.vmi == VMIRef("default", "vm-1-3", "node-1")
+    assert all(r.duration > 0 for r in results)
+
+
+def test_migrate_timeout():
+    vmis = [_vmi(f"vm-{idx}", "node-0") for idx in range(3)]
+    cluster = FakeCluster(vmis, stall={"vm-1"})
+    migrator = Migrator(cluster, per_cluster=1)
+    migratable, _ = migrator.vmis_on(["node-0"])
+    start = time.monotonic()
+    results = migrator.migrate(migratable, timeout=0.2)
+    assert time.monotonic() - start < 5
+    assert [(r.vmi.name, r.phase) for r in results] == [
+        ("vm-0", "Succeeded"),
+        ("vm-1", "TimedOut"),
+        ("vm-2", "NotStarted"),
+    ]
+
+
+def test_migrate_nothing():
+    migrator = Migrator(FakeCluster([]))
+    assert migrator.migrate([]) == []
+
+
+@pytest.fixture
+def harness():
+    harness = ops.testing.Harness(CharmKubeVirtCharm)
+    harness.begin()
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def test_drain_node_action(harness, lk_client):
+    cluster = FakeCluster([_vmi("vm-0", "node-0"), _vmi("vm-1", "node-0", False)])
+    for method in ("list", "patch", "create", "watch"):
+        getattr(lk_client, method).side_effect = getattr(cluster, method)
+
+    output = harness.run_action("drain-node", {"nodes": "node-0"})
+    assert cluster.patched == [("node-0", {"spec": {"unschedulable": True}})]
+    assert output.results["not-migratable"] == "default/vm-1"
+    assert output.results["summary"] == "1 migrated, 0 failed, 1 not migratable"
+    assert output.results["migrations"].startswith(
+        "default/vm-0 from node-0: Succeeded in "
+    )
+
+
+def test_drain_node_action_timeout(harness, lk_client):
+    cluster = FakeCluster([_vmi("vm-0", "node-0")], stall={"vm-0"})
+    for method in ("list", "patch", "create", "watch"):
+        getattr(lk_client, method).side_effect = getattr(cluster, method)
+
+    with pytest.raises(ops.testing.ActionFailed) as failed:
+        harness.run_action("drain-node", {"nodes": "node-0", "timeout": 1})
+    assert failed.value.message == "1 migrations timed out"
+    assert failed.value.output.results["timed-out"] == "default/vm-0"
+    assert failed.value.output.results["summary"] == (
+        "0 migrated, 0 failed, 1 timed out, 0 not migratable"
+    )
+
+
+def _loads(count, nodes, migratable=lambda idx: True):
+    return [
+        VMILoad(
+            VMIRef("default", f"vm-{idx}", nodes[idx % len(nodes)]),
+            cpu=1.0,
+            memory=2 * 2**30,
+            migratable=migratable(idx),
+        )
+        for idx in range(count)
+    ]
+
+
+def _spread(capacity, vmis, plan):
+    node_of = {m.vmi: m.target for m in plan}
+    load = dict.fromkeys(capacity, 0.0)
+    for vmi in vmis:
+        node = node_of.get(vmi.vmi, vmi.vmi.node)
+        cpu, memory = capacity[node]
+        load[node] += (vmi.cpu / cpu + vmi.memory / memory) / 2
+    return max(load.values()) - min(load.values())
+
+
+def test_plan_rebalance_thousands_of_vmis():
+    capacity = {f"node-{n}": (128.0, 512 * 2**30) for n in range(20)}
+    # 4000 VMIs packed on the first 5 nodes, every 7th isn't migratable
+    vmis = _loads(4000, [f"node-{n}" for n in range(5)], lambda idx: idx % 7)
+    start = time.perf_counter()
+    plan = plan_rebalance(capacity, vmis, max_migrations=3000)
+    elapsed = time.perf_counter() - start
+
+    assert len(plan) == len({m.vmi for m in plan}) <= 3000
+    assert all(m.vmi.node != m.target for m in plan)
+    assert _spread(capacity, vmis, plan) < 0.01 < _spread(capacity, vmis, [])
+    assert elapsed < 10
+
+    capped = plan_rebalance(capacity, vmis, max_migrations=100)
+    assert capped == plan[:100]
+
+
+def test_plan_rebalance_balanced():
+    capacity = {"a": (8.0, 2**35), "b": (8.0, 2**35)}
+    assert plan_rebalance(capacity, _loads(10, ["a", "b"]), 10) == []
+    assert plan_rebalance(capacity, _loads(10, ["a"], lambda _: False), 10) == []
+
+
+@pytest.mark.parametrize(
+    "quantity, value",
+    [
+        ("500m", 0.5),
+        ("4", 4.0),
+        (2, 2.0),
+        ("1Gi", 2**30),
+        ("1G", 1e9),
+        ("2k", 2e3),
+        ("250u", 250e-6),
+        ("1P", 1e15),
+        ("1E", 1e18),
+        ("1E3", 1e3),
+        ("1Pi", 2**50),
+        ("1Ei", 2**60),
+        ("5n", 5e-9),
+        ("-1.5e-3", -1.5e-3),
+        (".5", 0.5),
+    ],
+)
+def test_parse_quantity(quantity, value):
+    assert parse_quantity(quantity) == pytest.approx(value)
+
+
+@pytest.mark.parametrize("quantity", ["1K", "1KB", "Gi", "1e", "1.5.0", "inf", "1 Mi"])
+def test_parse_quantity_invalid(quantity):
+    with pytest.raises(ValueError):
+        parse_quantity(quantity)
+
+
+def test_rebalance_dry_run(harness, lk_client):
+    def listing(resource, namespace=None, labels=None):
+        if resource is Node:
+            assert labels == {"kubevirt.io/schedulable": "true"}
+            return [
+                Node.from_dict(
+                    {
+                        "metadata": {"name": name},
+                        "status": {"allocatable": {"cpu": "8", "memory": "32Gi"}},
+                    }
+                )
+                for name in ("node-0", "node-1")
+            ]
+        if resource is VirtualMachineInstance:
+            vmis = [_vmi(f"vm-{idx}", "node-0") for idx in range(4)]
+            for vmi in vmis:
+                vmi.spec = {
+                    "domain": {"resources": {"requests": {"cpu": "2", "memory": "4Gi"}}}
+                }
+            return vmis
+        return []
+
+    lk_client.list.side_effect = listing
+    output = harness.run_action("rebalance", {"dry-run": True})
+    assert output.results["plan"] == (
+        "default/vm-0: node-0 -> node-1\ndefault/vm-1: node-0 -> node-1"
+    )
+    assert output.results["summary"] == "2 migrations planned across 2 nodes"
+    lk_client.create.assert_not_called()
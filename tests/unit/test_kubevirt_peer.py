@@ -0,0 +1,74 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import logging
+import time
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+
+import kubevirt_peer
+from charm import CharmKubeVirtCharm
+
+log = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def peers(request):
+    units = request.param
+    harness = ops.testing.Harness(CharmKubeVirtCharm)
+    rel_id = harness.add_relation("kubevirts", "kubevirt")
+    harness.update_relation_data(rel_id, "kubevirt/0", {"supports-kvm": "false"})
+    for idx in range(1, units):
+        harness.add_relation_unit(rel_id, f"kubevirt/{idx}")
+        kvm = "true" if idx % 2 else "false"
+        harness.update_relation_data(rel_id, f"kubevirt/{idx}", {"supports-kvm": kvm})
+    try:
+        yield harness, rel_id
+    finally:
+        harness.cleanup()
+
+
+@pytest.mark.parametrize("peers", [500], indirect=True)
+def test_leader_summary_parses_peers_once(peers):
+    harness, rel_id = peers
+    harness.set_leader(True)
+    harness.begin()
+    peer = harness.charm.kube_virt
+
+    with mock.patch.object(
+        kubevirt_peer.Data, "parse_obj", wraps=kubevirt_peer.Data.parse_obj
+    ) as data:
+        start = time.perf_counter()
+        summary = peer.publish_summary()
+        publish = time.perf_counter() - start
+        assert data.call_count == 500
+
+        peer.invalidate()
+        start = time.perf_counter()
+        assert peer.publish_summary() == summary
+        unchanged = time.perf_counter() - start
+        assert data.call_count == 500
+
+    log.info(f"500 peers: publish={publish:.4f}s, unchanged={unchanged:.4f}s")
+    assert (summary.units, summary.kvm_units, summary.generation) == (500, 250, 1)
+    assert harness.get_relation_data(rel_id, "kubevirt")["generation"] == "1"
+
+
+@pytest.mark.parametrize("peers", [500], indirect=True)
+def test_non_leader_reads_summary(peers):
+    harness, rel_id = peers
+    harness.update_relation_data(
+        rel_id,
+        "kubevirt",
+        {"units": "500", "kvm-units": "0", "digest": "abc", "generation": "3"},
+    )
+    harness.begin()
+    peer = harness.charm.kube_virt
+
+    with mock.patch.object(
+        kubevirt_peer.Data, "parse_obj", wraps=kubevirt_peer.Data.parse_obj
+    ) as data:
+        assert peer.is_ready
+        assert peer.supports_kvm is False
+    data.assert_not_called()
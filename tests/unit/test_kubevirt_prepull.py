@@ -0,0 +1,206 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+from lightkube.models.apps_v1 import DaemonSetStatus
+from lightkube.models.core_v1 import ContainerStatus, PodStatus
+from lightkube.models.meta_v1 import ObjectMeta
+from lightkube.resources.apps_v1 import DaemonSet
+from lightkube.resources.core_v1 import Pod
+
+from charm import CharmKubeVirtCharm
+from kubevirt_prepull import (
+    CONTAINER_DISK_BINARY,
+    PREPULL_NAME,
+    RELEASE_ANNOTATION,
+    PrePuller,
+    launcher_image,
+)
+
+IMAGES = ["quay.io/kubevirt/virt-handler:v1", "quay.io/kubevirt/virt-launcher:v1"]
+
+
+def _daemonset(release, desired, observed=1):
+    return DaemonSet(
+        metadata=ObjectMeta(
+            name=PREPULL_NAME, annotations={RELEASE_ANNOTATION: release}, generation=1
+        ),
+        status=DaemonSetStatus(
+            currentNumberScheduled=desired,
+            desiredNumberScheduled=desired,
+            numberMisscheduled=0,
+            numberReady=0,
+            observedGeneration=observed,
+        ),
+    )
+
+
+def _pod(*image_ids):
+    statuses = [
+        ContainerStatus(
+            name=f"image-{idx}",
+            image=IMAGES[idx],
+            imageID=image_id,
+            ready=False,
+            restartCount=0,
+        )
+        for idx, image_id in enumerate(image_ids)
+    ]
+    return Pod(status=PodStatus(containerStatuses=statuses))
+
+
+@pytest.fixture
+def harness():
+    harness = ops.testing.Harness(CharmKubeVirtCharm)
+    harness.add_relation("kubevirts", "kubevirt")
+    harness.set_leader(True)
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+def test_daemonset_runs_each_image_on_every_node():
+    registry = mock.MagicMock(
+        side_effect=lambda obj: [
+            setattr(c, "image", c.image.replace("quay.io", "my.registry"))
+            for c in obj.spec.template.spec.initContainers
+            + obj.spec.template.spec.containers
+        ]
+    )
+    daemonset = PrePuller(mock.MagicMock(), "kubevirt", [registry]).daemonset(
+        "v1", IMAGES
+    )
+    spec = daemonset.spec.template.spec
+    assert daemonset.metadata.annotations == {RELEASE_ANNOTATION: "v1"}
+    assert [c.image for c in spec.containers] == [
+        "my.registry/kubevirt/virt-handler:v1",
+        "my.registry/kubevirt/virt-launcher:v1",
+    ]
+    # the pulled images only run the binary copied from virt-launcher
+    (binary,) = spec.initContainers
+    assert binary.image == "my.registry/kubevirt/virt-launcher:v1"
+    assert binary.command == [
+        "/usr/bin/cp",
+        CONTAINER_DISK_BINARY,
+        "/prepull/container-disk",
+    ]
+    assert {c.command[0] for c in spec.containers} == {"/prepull/container-disk"}
+    assert spec.tolerations[0].operator == "Exists"
+    registry.assert_called_once_with(daemonset)
+
+
+def test_launcher_image():
+    assert launcher_image(IMAGES) == IMAGES[1]
+    assert launcher_image(["my.reg:5000/kubevirt/virt-launcher@sha256:a"])
+    assert launcher_image(["quay.io/kubevirt/virt-launcher-extra:v1"]) is None
+
+
+def test_progress_counts_nodes_with_every_image():
+    client = mock.MagicMock()
+    client.get.return_value = _daemonset("v1", 3)
+    client.list.return_value = [
+        _pod("sha256:a", "sha256:b"),
+        _pod("sha256:a", ""),
+        _pod("sha256:a"),
+    ]
+    assert PrePuller(client, "kubevirt").progress("v1", IMAGES) == (1, 3)
+
+
+@pytest.mark.parametrize("release, observed", [("v0", 1), ("v1", None)])
+def test_progress_until_observed(release, observed):
+    client = mock.MagicMock()
+    client.get.return_value = _daemonset(release, 3, observed)
+    assert PrePuller(client, "kubevirt").progress("v1", IMAGES) is None
+    client.list.assert_not_called()
+
+
+def test_delete_ignores_missing(api_error_klass):
+    client = mock.MagicMock()
+    missing = api_error_klass()
+    missing.status.code = 404
+    client.delete.side_effect = missing
+    PrePuller(client, "kubevirt").delete()
+    client.delete.assert_called_once_with(DaemonSet, PREPULL_NAME, namespace="kubevirt")
+
+
+def test_release_images_from_inventory(harness):
+    images = harness.charm.kube_operator.release_images("v0.48.1")
+    assert "quay.io/kubevirt/virt-launcher:v0.48.1" in images
+    assert harness.charm.kube_operator.release_images("v0.0.0") == []
+
+
+@pytest.mark.parametrize(
+    "enabled, deployed, expected",
+    [(False, "v0.48.1", True), (True, None, True), (True, "latest", True)],
+)
+def test_prepull_not_needed(harness, enabled, deployed, expected):
+    harness.update_config({"prepull-images": enabled})
+    charm = harness.charm
+    if deployed:
+        charm.kube_virt.deployed_release = (
+            charm.kube_operator.current_release if deployed == "latest" else deployed
+        )
+    with mock.patch.object(charm, "_prepuller") as prepuller:
+        assert charm._prepull_images(mock.MagicMock()) is expected
+    prepuller.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "pulled, desired, ready", [(8, 10, False), (9, 10, True), (0, 0, True)]
+)
+def test_prepull_waits_for_threshold(harness, pulled, desired, ready):
+    harness.update_config({"prepull-images": True, "prepull-threshold": 90})
+    charm = harness.charm
+    charm.kube_virt.deployed_release = "v0.48.1"
+    event = mock.MagicMock()
+    with mock.patch.object(charm, "_prepuller") as prepuller:
+        puller = prepuller.return_value
+        puller.progress.return_value = (pulled, desired)
+        assert charm._prepull_images(event) is ready
+    release = charm.kube_operator.current_release
+    puller.apply.assert_called_once_with(release, mock.ANY)
+    if ready:
+        puller.delete.assert_called_once_with()
+        event.defer.assert_not_called()
+    else:
+        puller.delete.assert_not_called()
+        event.defer.assert_called_once_with()
+        assert charm.unit.status.message == (
+            f"Pre-pulling {release} images: 8/10 nodes"
+        )
+
+
+def test_prepull_waits_until_observed(harness):
+    harness.update_config({"prepull-images": True})
+    charm = harness.charm
+    charm.kube_virt.deployed_release = "v0.48.1"
+    event = mock.MagicMock()
+    with mock.patch.object(charm, "_prepuller") as prepuller:
+        prepuller.return_value.progress.return_value = None
+        assert charm._prepull_images(event) is False
+    prepuller.return_value.delete.assert_not_called()
+    event.defer.assert_called_once_with()
+
+
+def test_deployed_release_kept_by_the_app(harness):
+    rel_id = harness.model.get_relation("kubevirts").id
+    harness.charm.kube_virt.deployed_release = "v0.48.1"
+    assert harness.get_relation_data(rel_id, "kubevirt")["deployed-release"] == (
+        "v0.48.1"
+    )
+    # any unit, such as a later leader, reads it while only the leader writes it
+    harness.set_leader(False)
+    harness.charm.kube_virt.deployed_release = "v0.58.0"
+    assert harness.charm.kube_virt.deployed_release == "v0.48.1"
+
+
+@pytest.mark.parametrize("threshold, valid", [(0, True), (100, True), (101, False)])
+def test_prepull_threshold_validated(harness, threshold, valid):
+    harness.update_config({"prepull-threshold": threshold})
+    message = harness.charm.charm_config.evaluate()
+    if valid:
+        assert message is None
+    else:
+        assert message == "prepull-threshold 101 is not a percentage from 0 to 100"
@@ -0,0 +1,170 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import threading
+from copy import deepcopy
+
+from lightkube import codecs
+from lightkube.generic_resource import create_namespaced_resource
+from ops.manifests import HashableResource
+
+from kubevirt_teardown import Teardown, teardown_tiers
+
+KubeVirt = create_namespaced_resource("kubevirt.io", "v1", "KubeVirt", "kubevirts")
+LABELS = {"juju.io/application": "kubevirt"}
+MANIFESTS = [
+    {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": "kubevirt"}},
+    {
+        "apiVersion": "apiextensions.k8s.io/v1",
+        "kind": "CustomResourceDefinition",
+        "metadata": {"name": "kubevirts.kubevirt.io"},
+        "spec": {
+            "group": "kubevirt.io",
+            "names": {"kind": "KubeVirt", "plural": "kubevirts"},
+            "scope": "Namespaced",
+            "versions": [{"name": "v1", "served": True, "storage": True}],
+        },
+    },
+    {
+        "apiVersion": "rbac.authorization.k8s.io/v1",
+        "kind": "ClusterRole",
+        "metadata": {"name": "kubevirt-operator"},
+    },
+    {
+        "apiVersion": "v1",
+        "kind": "ServiceAccount",
+        "metadata": {"name": "kubevirt-operator", "namespace": "kubevirt"},
+    },
+    *(
+        {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": {"name": name, "namespace": "kubevirt"},
+            "spec": {"selector": {}, "template": {}},
+        }
+        for name in ("virt-operator", "virt-exporter")
+    ),
+    {
+        "apiVersion": "kubevirt.io/v1",
+        "kind": "KubeVirt",
+        "metadata": {"name": "kubevirt", "namespace": "kubevirt"},
+    },
+]
+
+
+class FakeCluster:
+    """Holds live objects, removing each a number of checks after its delete."""
+
+    def __init__(self, manifests, linger=None, finalizers=None, errors=None):
+        self.objects = {}
+        for manifest in manifests:
+            manifest = deepcopy(manifest)
+            manifest["metadata"]["labels"] = LABELS
+            metadata = manifest["metadata"]
+            kind_name = f"{manifest['kind']}/{metadata['name']}"
+            metadata["finalizers"] = (finalizers or {}).get(kind_name)
+            obj = codecs.from_dict(manifest)
+            self.objects[(type(obj), metadata.get("namespace"), metadata["name"])] = obj
+        self.linger = dict(linger or {})
+        self.errors = dict(errors or {})
+        self.deleting = set()
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def list(self, kind, namespace=None, labels=None):
+        assert labels == LABELS
+        for key in [k for k in self.deleting if k[0] is kind]:
+            name = key[2]
+            if self.linger.get(name, 0) > 0:
+                self.linger[name] -= 1
+            elif not self.objects[key].metadata.finalizers:
+                del self.objects[key]
+                self.deleting.discard(key)
+        return [
+            obj
+            for (k, ns, _), obj in self.objects.items()
+            if k is kind and ns == namespace
+        ]
+
+    def delete(self, kind, name, namespace=None):
+        with self.lock:
+            if name in self.errors:
+                raise self.errors[name]
+            self.deleted.append((kind.__name__, name))
+            self.deleting.add((kind, namespace, name))
+
+
+def _resources():
+    return [HashableResource(codecs.from_dict(deepcopy(m))) for m in MANIFESTS]
+
+
+def _teardown(cluster):
+    clock = iter(range(10**6)).__next__
+    return Teardown(
+        cluster, LABELS, workers=4, timeout=5, clock=clock, sleep=lambda _: None
+    )
+
+
+def test_tiers_order_dependents_first():
+    tiers = [sorted(r.kind for r in tier) for tier in teardown_tiers(_resources())]
+    assert tiers == [
+        ["KubeVirt"],
+        ["Deployment", "Deployment"],
+        ["ClusterRole", "ServiceAccount"],
+        ["CustomResourceDefinition", "Namespace"],
+    ]
+
+
+def test_teardown_waits_for_each_tier():
+    cluster = FakeCluster(MANIFESTS, linger={"kubevirt": 2})
+    result = _teardown(cluster).run(_resources())
+    assert result.deleted == len(MANIFESTS)
+    assert result.stuck == []
+    assert not cluster.objects
+    kinds = [kind for kind, _ in cluster.deleted]
+    assert kinds[0] == "KubeVirt"
+    assert set(kinds[1:3]) == {"Deployment"}
+    assert set(kinds[-2:]) == {"CustomResourceDefinition", "Namespace"}
+
+
+def test_teardown_removes_objects_of_earlier_releases():
+    retired = {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": "virt-retired", "namespace": "kubevirt"},
+        "spec": {"selector": {}, "template": {}},
+    }
+    cluster = FakeCluster(MANIFESTS + [retired])
+    result = _teardown(cluster).run(_resources())
+    assert result.deleted == len(MANIFESTS) + 1
+    assert ("Deployment", "virt-retired") in cluster.deleted
+    assert not cluster.objects
+
+
+def test_teardown_reports_stuck_finalizers():
+    cluster = FakeCluster(
+        MANIFESTS, finalizers={"KubeVirt/kubevirt": ["foregroundDeleteKubeVirt"]}
+    )
+    result = _teardown(cluster).run(_resources())
+    assert result.stuck == [
+        "KubeVirt/kubevirt/kubevirt (finalizers: foregroundDeleteKubeVirt)"
+    ]
+    # later tiers are still removed rather than blocking on the finalizer
+    assert result.deleted == len(MANIFESTS) - 1
+    assert ("Namespace", "kubevirt") in cluster.deleted
+
+
+def test_teardown_reports_failed_deletes(api_error_klass):
+    forbidden = api_error_klass()
+    forbidden.status.code = 403
+    forbidden.status.message = "forbidden"
+    cluster = FakeCluster(MANIFESTS, errors={"kubevirt-operator": forbidden})
+    sleeps = []
+    teardown = _teardown(cluster)
+    teardown.sleep = sleeps.append
+    result = teardown.run(_resources())
+    assert result.stuck == [
+        "ClusterRole/kubevirt-operator (forbidden)",
+        "ServiceAccount/kubevirt/kubevirt-operator (forbidden)",
+    ]
+    # objects which failed to delete aren't waited on until the timeout
+    assert len(sleeps) < teardown.timeout
@@ -0,0 +1,195 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import json
+import sys
+import textwrap
+import unittest.mock as mock
+
+import pytest
+
+from upstream import update
+
+FAKE_REGSYNC = """\
+#!{python}
+import os, sys, yaml
+config = yaml.safe_load(open(sys.argv[sys.argv.index("-c") + 1]))
+with open(os.environ["FAKE_REGSYNC_LOG"], "a") as log:
+    for asset in config["sync"]:
+        print(f"syncing {{asset['source']}}")
+        log.write(asset["source"] + "\\n")
+failing = os.environ.get("FAKE_REGSYNC_FAIL")
+sys.exit(1 if failing and any(failing in a["source"] for a in config["sync"]) else 0)
+"""
+
+
+@pytest.fixture
+def regsync(tmp_path, monkeypatch):
+    binary = tmp_path / "regsync"
+    binary.write_text(FAKE_REGSYNC.format(python=sys.executable))
+    binary.chmod(0o755)
+    sync_log = tmp_path / "regsync.log"
+    sync_log.touch()
+    monkeypatch.setenv("FAKE_REGSYNC_LOG", str(sync_log))
+    yield binary, sync_log
+
+
+@pytest.fixture
+def registry(tmp_path):
+    pass_file = tmp_path / "pass"
+    pass_file.write_text("secret\n")
+    yield update.Registry("my.registry:5000", "mirror", "user", str(pass_file))
+
+
+@pytest.fixture
+def digests(monkeypatch):
+    known = {}
+    monkeypatch.setattr(update, "source_digest", lambda image: known.get(str(image)))
+    yield known
+
+
+def test_extract_images_from_operator_env(tmp_path):
+    manifest = tmp_path / "000-kubevirt-operator.yaml"
+    manifest.write_text(
+        textwrap.dedent(
+            """\
+            apiVersion: v1
+            kind: Namespace
+            metadata:
+              name: kubevirt
+            ---
+            apiVersion: apps/v1
+            kind: Deployment
+            metadata:
+              name: virt-operator
+            spec:
+              template:
+                spec:
+                  initContainers:
+                  - name: init
+                    image: quay.io/kubevirt/init:v1.0.0
+                  containers:
+                  - name: virt-operator
+                    image: quay.io/kubevirt/virt-operator:v1.0.0
+                    env:
+                    - name: OPERATOR_IMAGE
+                      value: quay.io/kubevirt/virt-operator:v1.0.0
+                    - name: VIRT_HANDLER_SHASUM
+                      value: sha256:abc
+            """
+        )
+    )
+    found = {str(image) for image in update.extract_images(manifest)}
+    assert found == {
+        "quay.io/kubevirt/init:v1.0.0",
+        "quay.io/kubevirt/virt-operator:v1.0.0",
+        "quay.io/kubevirt/virt-api:v1.0.0",
+        "quay.io/kubevirt/virt-controller:v1.0.0",
+        "quay.io/kubevirt/virt-handler@sha256:abc",
+        "quay.io/kubevirt/virt-launcher:v1.0.0",
+    }
+
+
+def test_mirror_image_skips_synced_digests(tmp_path, regsync, registry, digests):
+    binary, sync_log = regsync
+    mirror = update.Mirror(workers=3, regsync=str(binary), state=tmp_path / "state")
+    images = [f"quay.io/kubevirt/virt-{n}:v1.0.0" for n in ("api", "handler", "x")]
+    digests.update({image: f"sha256:{idx}" for idx, image in enumerate(images)})
+
+    update.mirror_image(images, registry, mirror)
+    assert sorted(sync_log.read_text().split()) == sorted(images)
+    state = json.loads(mirror.state.read_text())["my.registry:5000/mirror"]
+    assert state == {image: digests[image] for image in images}
+
+    # only the image with a changed source digest is synced again
+    sync_log.write_text("")
+    digests[images[1]] = "sha256:changed"
+    update.mirror_image(images, registry, mirror)
+    assert sync_log.read_text().split() == [images[1]]
+
+
+def test_mirror_image_failed_worker(tmp_path, regsync, registry, digests, monkeypatch):
+    binary, _ = regsync
+    monkeypatch.setenv("FAKE_REGSYNC_FAIL", "virt-handler")
+    mirror = update.Mirror(workers=2, regsync=str(binary), state=tmp_path / "state")
+    images = [
+        "quay.io/kubevirt/virt-api:v1.0.0",
+        "quay.io/kubevirt/virt-handler:v1.0.0",
+    ]
+    digests.update({image: "sha256:0" for image in images})
+
+    with pytest.raises(update.UpdateError, match="virt-handler"):
+        update.mirror_image(images, registry, mirror)
+    state = json.loads(mirror.state.read_text())["my.registry:5000/mirror"]
+    assert state == {"quay.io/kubevirt/virt-api:v1.0.0": "sha256:0"}
+
+
+def test_gather_releases_follows_pages(fake_github):
+    github = fake_github(releases=7, per_page=3)
+    releases = update.gather_releases("operator")
+    assert {r.name for r in releases} == set(github.tags)
+    assert github.requests == 3
+
+
+def test_main_dedupes_downloaded_releases(fake_github, tmp_path):
+    fake_github(releases=5)
+    latest, images = update.main("operator", None)
+    assert latest == "v1.1.0"
+    remaining = sorted(p.name for p in (tmp_path / "operator/manifests").iterdir())
+    assert remaining == ["v1.0.0", "v1.1.0"]
+    assert "quay.io/kubevirt/virt-handler:v1.1" in images
+    assert (tmp_path / "operator/manifests/v1.1.0" / update.INVENTORY).exists()
+
+    # a second run recognises the local releases and doesn't download them again
+    with mock.patch.object(update, "download", wraps=update.download) as download:
+        assert update.main("operator", None)[0] == "v1.1.0"
+    downloaded = {call.args[1].name for call in download.call_args_list}
+    assert not downloaded & {"v1.0.0", "v1.1.0"}
+
+
+def test_pin_digests_reuses_known(digests):
+    images = [
+        update.Image("quay.io/kubevirt/virt-api", "v1.0.0"),
+        update.Image("quay.io/kubevirt/virt-handler", "v1.0.0"),
+        update.Image("quay.io/kubevirt/virt-launcher", digest="sha256:c"),
+        update.Image("quay.io/kubevirt/missing", "v1.0.0"),
+    ]
+    digests["quay.io/kubevirt/virt-handler:v1.0.0"] = "sha256:b"
+    known = {"quay.io/kubevirt/virt-api:v1.0.0": "sha256:a"}
+    with mock.patch.object(
+        update, "source_digest", wraps=update.source_digest
+    ) as resolve:
+        pinned = update.pin_digests(images, known, workers=2)
+    assert [str(i) for i in pinned] == [
+        "quay.io/kubevirt/virt-api@sha256:a",
+        "quay.io/kubevirt/virt-handler@sha256:b",
+        "quay.io/kubevirt/virt-launcher@sha256:c",
+        "quay.io/kubevirt/missing:v1.0.0",
+    ]
+    assert pinned[0].tag == "v1.0.0"
+    assert {str(c.args[0]) for c in resolve.call_args_list} == {
+        "quay.io/kubevirt/virt-handler:v1.0.0",
+        "quay.io/kubevirt/missing:v1.0.0",
+    }
+
+
+def test_main_pins_inventory_digests(fake_github, tmp_path, digests):
+    fake_github(releases=3)
+    digests["quay.io/kubevirt/virt-handler:v1.0"] = "sha256:handler"
+    _, images = update.main("operator", None, pin=True)
+    assert "quay.io/kubevirt/virt-handler@sha256:handler" in images
+    inventory = tmp_path / "operator/manifests/v1.0.0" / update.INVENTORY
+    pinned = json.loads(inventory.read_text())["images"]
+    assert {
+        "repository": "quay.io/kubevirt/virt-handler",
+        "tag": "v1.0",
+        "digest": "sha256:handler",
+    } in pinned
+
+
+def test_main_keeps_pinned_digests(fake_github, tmp_path, digests):
+    fake_github(releases=3)
+    digests["quay.io/kubevirt/virt-handler:v1.0"] = "sha256:handler"
+    update.main("operator", None, pin=True)
+    digests.clear()
+    _, images = update.main("operator", None)
+    assert "quay.io/kubevirt/virt-handler@sha256:handler" in images
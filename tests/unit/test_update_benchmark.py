@@ -0,0 +1,42 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import logging
+import time
+from contextlib import contextmanager
+from itertools import accumulate
+
+import pytest
+
+from upstream import update
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def stopwatch(timings, phase):
+    start = time.perf_counter()
+    yield
+    timings[phase] = time.perf_counter() - start
+
+
+@pytest.mark.parametrize("count", [10, 50, 200])
+def test_update_benchmark(fake_github, count):
+    github = fake_github(releases=count, latency=0.001)
+    timings = {}
+
+    with stopwatch(timings, "discovery"):
+        releases = update.gather_releases("operator")
+    with stopwatch(timings, "download"):
+        local = [update.download("operator", release) for release in releases]
+    with stopwatch(timings, "dedupe"):
+        unique = list(dict.fromkeys(accumulate(sorted(local), update.dedupe)))
+    with stopwatch(timings, "images"):
+        images = {image for release in unique for image in update.images(release)}
+
+    log.info(
+        f"{count} releases: "
+        + ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in timings.items())
+    )
+    assert len(releases) == count
+    assert len(unique) == len(set(map(github.content, github.tags)))
+    assert len(images) == 5 * len(unique)
@@ -5,6 +5,7 @@
 
 import argparse
 import contextlib
+import hashlib
 import json
 import logging
 import re
@@ -12,12 +13,24 @@ import subprocess
 import sys
 import urllib.error
 import urllib.request
-from collections import defaultdict
-from dataclasses import dataclass
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
 from itertools import accumulate
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Generator, List, Optional, Set, Tuple, TypedDict
+from typing import (
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+)
+from urllib.parse import urlencode
 
 import yaml
 from semver import VersionInfo
@@ -25,10 +38,19 @@ from semver import VersionInfo
 log = logging.getLogger("updating kubevirt")
 logging.basicConfig(level=logging.INFO)
 GH_REPO = "https://api.github.com/repos/{repo}"
-GH_TAGS = "https://api.github.com/repos/{repo}/tags"
+GH_TAGS = "https://api.github.com/repos/{repo}/tags?per_page=100"
 GH_BRANCH = "https://api.github.com/repos/{repo}/branches/{branch}"
 GH_COMMIT = "https://api.github.com/repos/{repo}/commits/{sha}"
 GH_RAW = "https://github.com/{repo}/{path}/{rel}/{manifest}"
+REGISTRY_MANIFEST = "https://{registry}/v2/{repository}/manifests/{reference}"
+MANIFEST_TYPES = ", ".join(
+    [
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ]
+)
 
 SOURCES = dict(
     operator=dict(
@@ -46,7 +68,24 @@ SOURCES = dict(
 )
 FILEDIR = Path(__file__).parent
 VERSION_RE = re.compile(r"^v\d+\.\d+")
-IMG_RE = re.compile(r"^\s+image:\s+(\S+)")
+LINK_NEXT_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+ENUMERATED_RE = re.compile(r"^\d{3}-")
+VIRT_ENV_RE = re.compile(r"^VIRT_(\w+)_(IMAGE|SHASUM)$")
+INVENTORY = "images.json"
+INDEX = "index.json"
+DOC_SEPARATOR = re.compile(rb"^---[ \t]*$", re.MULTILINE)
+# images the virt-operator deploys itself, named relative to the OPERATOR_IMAGE
+OPERATOR_COMPONENTS = ["virt-api", "virt-controller", "virt-handler", "virt-launcher"]
+POD_SPEC_PATHS = {
+    "Pod": ("spec",),
+    "DaemonSet": ("spec", "template", "spec"),
+    "Deployment": ("spec", "template", "spec"),
+    "Job": ("spec", "template", "spec"),
+    "ReplicaSet": ("spec", "template", "spec"),
+    "ReplicationController": ("spec", "template", "spec"),
+    "StatefulSet": ("spec", "template", "spec"),
+    "CronJob": ("spec", "jobTemplate", "spec", "template", "spec"),
+}
 
 
 @dataclass(frozen=True)
@@ -68,6 +107,26 @@ class Registry:
         }
 
 
+@dataclass(frozen=True)
+class Mirror:
+    """Options controlling how images are mirrored."""
+
+    workers: int = 1
+    regsync: str = "./regsync"
+    state: Path = FILEDIR / "mirror-state.json"
+    # lines of regsync output kept per worker for the failure summary
+    log_lines: int = 50
+
+
+@dataclass
+class SyncResult:
+    """Outcome of one regsync worker."""
+
+    images: List[str]
+    returncode: int
+    tail: List[str] = field(default_factory=list)
+
+
 @dataclass
 class Release:
     """Defines a release type."""
@@ -89,6 +148,30 @@ class Release:
         return VersionInfo.parse(a) < VersionInfo.parse(b)
 
 
+@dataclass(frozen=True)
+class Image:
+    """Container image reference, pinned either by tag or by digest."""
+
+    repository: str
+    tag: Optional[str] = None
+    digest: Optional[str] = None
+
+    @classmethod
+    def parse(cls, ref: str) -> "Image":
+        """Split an image reference into repository, tag and digest."""
+        ref, _, digest = ref.partition("@")
+        repository, tag = ref, None
+        if ":" in ref.rsplit("/", 1)[-1]:
+            repository, tag = ref.rsplit(":", 1)
+        return cls(repository, tag, digest or None)
+
+    def __str__(self) -> str:
+        """Full image reference, preferring the digest over the tag."""
+        if self.digest:
+            return f"{self.repository}@{self.digest}"
+        return f"{self.repository}:{self.tag}" if self.tag else self.repository
+
+
 SyncAsset = TypedDict("SyncAsset", {"source": str, "target": str, "type": str})
 SyncCreds = TypedDict("SyncCreds", {"registry": str, "user": str, "pass": str})
 
@@ -108,7 +191,13 @@ def sync_asset(image: str, registry: Registry):
     return SyncAsset(source=image, target=dest, type="image")
 
 
-def main(source: str, registry: Optional[Registry]):
+def main(
+    source: str,
+    registry: Optional[Registry],
+    mirror: Optional[Mirror] = None,
+    index: bool = False,
+    pin: bool = False,
+):
     """Main update logic."""
     local_releases = gather_current(source)
     gh_releases = gather_releases(source)
@@ -116,44 +205,57 @@ def main(source: str, registry: Optional[Registry]):
     for release in new_releases:
         local_releases.add(download(source, release))
     unique_releases = list(dict.fromkeys(accumulate((sorted(local_releases)), dedupe)))
-    all_images = set(image for release in unique_releases for image in images(release))
+    workers = (mirror or Mirror()).workers
+    all_images = set(
+        image for release in unique_releases for image in images(release, pin, workers)
+    )
+    if index:
+        for release in unique_releases:
+            index_manifests(release)
     if registry:
-        mirror_image(all_images, registry)
+        mirror_image(all_images, registry, mirror or Mirror())
     return unique_releases[-1].name, all_images
 
 
+def _paginate(url: str) -> Generator[Mapping, None, None]:
+    """Yield every item of a paginated github api listing."""
+    next_url: Optional[str] = url
+    while next_url:
+        with urllib.request.urlopen(next_url) as resp:
+            yield from json.load(resp)
+            links = LINK_NEXT_RE.search(resp.headers.get("Link") or "")
+        next_url = links.group(1) if links else None
+
+
 def gather_releases(source: str) -> Tuple[str, Set[Release]]:
     """Fetch from github the release manifests by version."""
     context = dict(**SOURCES[source])
     version_parser = context["version_parser"]
     if context.get("release_tags"):
-        with urllib.request.urlopen(GH_TAGS.format(**context)) as resp:
-            possible = json.load(resp)
-            releases = sorted(
-                [
-                    Release(
-                        item["name"],
-                        [
-                            GH_RAW.format(
-                                rel=item["name"], manifest=manifest, **context
-                            )
-                            for manifest in context["manifests"]
-                        ],
-                    )
-                    for item in possible
-                    if (
-                        VERSION_RE.match(item["name"])
-                        and not version_parser(item["name"][1:]).prerelease
-                        and (
-                            version_parser(context["minimum"][1:])
-                            <= version_parser(item["name"][1:])
-                            < version_parser(context["maximum"][1:])
-                        )
+        possible = _paginate(GH_TAGS.format(**context))
+        releases = sorted(
+            [
+                Release(
+                    item["name"],
+                    [
+                        GH_RAW.format(rel=item["name"], manifest=manifest, **context)
+                        for manifest in context["manifests"]
+                    ],
+                )
+                for item in possible
+                if (
+                    VERSION_RE.match(item["name"])
+                    and not version_parser(item["name"][1:]).prerelease
+                    and (
+                        version_parser(context["minimum"][1:])
+                        <= version_parser(item["name"][1:])
+                        < version_parser(context["maximum"][1:])
                     )
-                ],
-                key=lambda r: version_parser(r.name[1:]),
-                reverse=True,
-            )
+                )
+            ],
+            key=lambda r: version_parser(r.name[1:]),
+            reverse=True,
+        )
 
     return set(releases)
 
@@ -162,8 +264,8 @@ def gather_current(source: str) -> Set[Release]:
     """Gather currently supported manifests by the charm."""
     manifests = SOURCES[source]["manifests"]
     releases = defaultdict(list)
-    for release_path in (FILEDIR / source / "manifests").glob("*/*.yaml"):
-        if release_path.name in manifests:
+    for release_path in sorted((FILEDIR / source / "manifests").glob("*/*.yaml")):
+        if ENUMERATED_RE.sub("", release_path.name) in manifests:
             releases[release_path.parent.name].append(release_path)
     return set(Release(version, files) for version, files in releases.items())
 
@@ -224,41 +326,323 @@ def dedupe(this: Release, next: Release) -> Release:
 
     for path in next.paths:
         path.unlink()
+    (path.parent / INVENTORY).unlink(missing_ok=True)
+    (path.parent / INDEX).unlink(missing_ok=True)
     path.parent.rmdir()
     log.info(f"Deleting Duplicate Release {next.name}")
     return this
 
 
-def images(release: Release) -> Generator[str, None, None]:
+def _pod_spec(doc: Mapping) -> Optional[Mapping]:
+    """Find the pod spec within a workload resource."""
+    path = POD_SPEC_PATHS.get(doc.get("kind", ""))
+    spec: Optional[Mapping] = doc if path else None
+    for key in path or ():
+        spec = (spec or {}).get(key)
+    return spec
+
+
+def _env_images(env: Mapping[str, str]) -> Generator[Image, None, None]:
+    """Yield images the virt-operator is told about through its environment.
+
+    The operator deploys its components from the same repository and tag
+    as OPERATOR_IMAGE, unless overridden by VIRT_<COMPONENT>_IMAGE or
+    pinned by VIRT_<COMPONENT>_SHASUM.
+    """
+    operator = env.get("OPERATOR_IMAGE")
+    if not operator:
+        return
+    operator_image = Image.parse(operator)
+    yield operator_image
+
+    prefix = operator_image.repository.rsplit("/", 1)[0]
+    tag = env.get("KUBEVIRT_VERSION") or operator_image.tag
+    components: Dict[str, Image] = {
+        name: Image(f"{prefix}/{name}", tag=tag) for name in OPERATOR_COMPONENTS
+    }
+    for key, value in env.items():
+        m = VIRT_ENV_RE.match(key)
+        if not (m and value) or m.group(1) == "OPERATOR":
+            continue
+        name = "virt-" + m.group(1).lower().replace("_", "-")
+        if m.group(2) == "IMAGE":
+            components[name] = Image.parse(value)
+        elif name not in components or not components[name].digest:
+            components[name] = Image(f"{prefix}/{name}", digest=value)
+    yield from components.values()
+
+
+def _flatten(docs: Iterable) -> Generator[Mapping, None, None]:
+    """Yield each kubernetes resource, unpacking any *List kinds."""
+    for doc in docs:
+        if not isinstance(doc, Mapping):
+            continue
+        if doc.get("kind", "").endswith("List"):
+            yield from _flatten(doc.get("items") or [])
+        else:
+            yield doc
+
+
+def extract_images(manifest: Path) -> Generator[Image, None, None]:
+    """Stream a manifest one document at a time, yielding every referenced image.
+
+    Walks the containers and init containers of each workload, and the
+    environment variables the virt-operator uses to find its components.
+    """
+    with manifest.open() as fp:
+        for doc in _flatten(yaml.safe_load_all(fp)):
+            spec = _pod_spec(doc) or {}
+            for container in (spec.get("initContainers") or []) + (
+                spec.get("containers") or []
+            ):
+                if container.get("image"):
+                    yield Image.parse(container["image"])
+                env = {
+                    e["name"]: e["value"]
+                    for e in container.get("env") or []
+                    if isinstance(e.get("value"), str)
+                }
+                yield from _env_images(env)
+
+
+def _pinned(inventory: Path) -> Dict[str, str]:
+    """Digests already pinned in an inventory, keyed by tagged image reference."""
+    if not inventory.exists():
+        return {}
+    images = json.loads(inventory.read_text())["images"]
+    return {
+        str(Image(i["repository"], i["tag"])): i["digest"]
+        for i in images
+        if i.get("tag") and i.get("digest")
+    }
+
+
+def pin_digests(
+    images: List[Image], known: Mapping[str, str], workers: int = 1
+) -> List[Image]:
+    """Pin each tagged image to the digest its tag resolves to.
+
+    Digests in known are reused rather than resolved again, as release tags
+    aren't expected to move. Images whose digest can't be resolved stay
+    referenced by tag.
+    """
+    unknown = [i for i in images if not i.digest and str(i) not in known]
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        resolved = dict(zip(map(str, unknown), pool.map(source_digest, unknown)))
+    pinned = []
+    for image in images:
+        digest = image.digest or known.get(str(image)) or resolved.get(str(image))
+        pinned.append(Image(image.repository, image.tag, digest))
+    return pinned
+
+
+def inventory(release: Release, pin: bool = False, workers: int = 1) -> List[Image]:
+    """Build and persist the image inventory alongside the release manifests.
+
+    With pin, tagged images are recorded with the digest of their tag.
+    Otherwise digests already pinned in the inventory are carried forward.
+    """
+    found = dict.fromkeys(
+        image for path in release.paths for image in extract_images(Path(path))
+    )
+    images = sorted(found, key=str)
+    dest = Path(release.paths[0]).parent / INVENTORY
+    known = _pinned(dest)
+    if pin:
+        images = pin_digests(images, known, workers)
+    else:
+        images = [
+            Image(i.repository, i.tag, i.digest or known.get(str(i))) for i in images
+        ]
+    content = {"release": release.name, "images": [asdict(i) for i in images]}
+    dest.write_text(json.dumps(content, indent=2) + "\n")
+    return images
+
+
+def _index_entry(doc: Mapping, content: bytes, offset: int) -> Dict:
+    """Describe one manifest document and where it lives in its file."""
+    length = len(content)
+    metadata = doc.get("metadata") or {}
+    entry = {
+        "kind": doc.get("kind"),
+        "name": metadata.get("name"),
+        "namespace": metadata.get("namespace"),
+        "offset": offset,
+        "length": length,
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+    if doc.get("kind") == "CustomResourceDefinition":
+        # enough to register the custom resource without parsing the whole CRD
+        spec = doc["spec"]
+        entry["crd"] = {
+            "group": spec["group"],
+            "kind": spec["names"]["kind"],
+            "plural": spec["names"]["plural"],
+            "scope": spec["scope"],
+            "versions": [v["name"] for v in spec["versions"]],
+        }
+    return entry
+
+
+def index_manifests(release: Release) -> Dict:
+    """Write an offset index of every document in each release manifest.
+
+    The index lets the charm parse only the documents of the kinds it needs.
+    """
+    files = {}
+    for path in map(Path, release.paths):
+        content = path.read_bytes()
+        separators = list(DOC_SEPARATOR.finditer(content))
+        starts = [0] + [m.end() for m in separators]
+        ends = [m.start() for m in separators] + [len(content)]
+        documents = []
+        for start, end in zip(starts, ends):
+            doc = yaml.safe_load(content[start:end])
+            if isinstance(doc, Mapping) and doc.get("kind"):
+                documents.append(_index_entry(doc, content[start:end], start))
+        files[path.name] = {
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "documents": documents,
+        }
+    index = {"release": release.name, "files": files}
+    dest = Path(release.paths[0]).parent / INDEX
+    dest.write_text(json.dumps(index, indent=1) + "\n")
+    return index
+
+
+def images(
+    release: Release, pin: bool = False, workers: int = 1
+) -> Generator[str, None, None]:
     """Yield all images from each release."""
-    for path in release.paths:
-        manifest = FILEDIR / source / "manifests" / release.name / Path(path).name
-        with manifest.open() as fp:
-            for line in fp:
-                m = IMG_RE.match(line)
-                if m:
-                    yield m.groups()[0]
+    for image in inventory(release, pin, workers):
+        yield str(image)
 
 
-def mirror_image(images: List[str], registry: Registry):
-    """Synchronize all source images to target registry, only pushing changed layers."""
+def _bearer_token(challenge: str) -> Optional[str]:
+    """Fetch an anonymous token described by a WWW-Authenticate challenge."""
+    scheme, _, params = challenge.partition(" ")
+    if scheme.lower() != "bearer":
+        return None
+    values = dict(re.findall(r'(\w+)="([^"]*)"', params))
+    realm = values.pop("realm", None)
+    if not realm:
+        return None
+    with urllib.request.urlopen(f"{realm}?{urlencode(values)}") as resp:
+        body = json.load(resp)
+    return body.get("token") or body.get("access_token")
+
+
+def source_digest(image: Image) -> Optional[str]:
+    """Resolve the manifest digest of a source image from its registry.
+
+    Returns None when the digest cannot be determined, in which case the
+    image is always synced.
+    """
+    if image.digest:
+        return image.digest
+    registry, repository = image.repository.split("/", 1)
+    url = REGISTRY_MANIFEST.format(
+        registry=registry, repository=repository, reference=image.tag or "latest"
+    )
+    headers = {"Accept": MANIFEST_TYPES}
+    for _ in range(2):
+        request = urllib.request.Request(url, headers=headers, method="HEAD")
+        try:
+            with urllib.request.urlopen(request) as resp:
+                return resp.headers.get("Docker-Content-Digest")
+        except urllib.error.HTTPError as e:
+            challenge = e.headers.get("WWW-Authenticate", "")
+            token = e.code == 401 and "Authorization" not in headers
+            token = token and _bearer_token(challenge)
+            if not token:
+                log.warning(f"Cannot resolve digest of {image}: {e}")
+                return None
+            headers["Authorization"] = f"Bearer {token}"
+        except urllib.error.URLError as e:
+            log.warning(f"Cannot resolve digest of {image}: {e}")
+            return None
+    return None
+
+
+def _load_state(mirror: Mirror, registry: Registry) -> Dict[str, str]:
+    """Load source digests already synced to this registry."""
+    if not mirror.state.exists():
+        return {}
+    target = f"{registry.name}/{registry.path.strip('/')}"
+    return json.loads(mirror.state.read_text()).get(target, {})
+
+
+def _save_state(mirror: Mirror, registry: Registry, synced: Dict[str, str]):
+    """Persist source digests synced to this registry."""
+    state = json.loads(mirror.state.read_text()) if mirror.state.exists() else {}
+    target = f"{registry.name}/{registry.path.strip('/')}"
+    state[target] = dict(sorted(synced.items()))
+    mirror.state.write_text(json.dumps(state, indent=2) + "\n")
+
+
+def _regsync(registry: Registry, mirror: Mirror, images: List[str]) -> SyncResult:
+    """Run one regsync worker over a shard of images."""
     sync_config = SyncConfig(
         version=1,
         creds=[registry.creds],
         sync=[sync_asset(image, registry) for image in images],
     )
-    with NamedTemporaryFile(mode="w") as tmpfile:
+    tail: deque = deque(maxlen=mirror.log_lines)
+    with NamedTemporaryFile(mode="w", suffix=".yaml") as tmpfile:
         yaml.safe_dump(sync_config, tmpfile)
+        tmpfile.flush()
         proc = subprocess.Popen(
-            ["./regsync", "once", "-c", tmpfile.name, "-v", "debug"],
+            [mirror.regsync, "once", "-c", tmpfile.name, "-v", "debug"],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             encoding="utf-8",
         )
-        while proc.returncode is None:
-            for line in proc.stdout:
-                print(line.strip())
-            proc.poll()
+        for line in proc.stdout or []:
+            log.debug(line.rstrip())
+            tail.append(line.rstrip())
+        proc.wait()
+    return SyncResult(images, proc.returncode, list(tail))
+
+
+def mirror_image(images: Iterable[str], registry: Registry, mirror: Mirror):
+    """Synchronize new or changed source images to the target registry.
+
+    Images whose source digest matches the one recorded in the mirror state
+    are skipped. The rest are sharded across parallel regsync workers.
+    """
+    synced = _load_state(mirror, registry)
+    workers = max(mirror.workers, 1)
+    with ThreadPoolExecutor(workers) as pool:
+        candidates = sorted(set(images))
+        digests = dict(
+            zip(candidates, pool.map(source_digest, map(Image.parse, candidates)))
+        )
+        pending = [
+            image
+            for image, digest in digests.items()
+            if digest is None or synced.get(image) != digest
+        ]
+        shards = [shard for i in range(workers) if (shard := pending[i::workers])]
+        results = list(pool.map(lambda s: _regsync(registry, mirror, s), shards))
+
+    failed = []
+    for result in results:
+        if result.returncode == 0:
+            synced.update({i: d for i in result.images if (d := digests[i])})
+        else:
+            failed += result.images
+            log.error(
+                f"regsync failed ({result.returncode}):\n" + "\n".join(result.tail)
+            )
+    _save_state(mirror, registry, synced)
+
+    log.info(
+        f"Mirrored {len(pending) - len(failed)} images, "
+        f"{len(digests) - len(pending)} up-to-date, "
+        f"{len(failed)} failed across {len(shards)} workers"
+    )
+    if failed:
+        raise UpdateError(f"Failed to mirror images: {', '.join(failed)}")
 
 
 def get_argparser():
@@ -280,6 +664,38 @@ def get_argparser():
         "(https://github.com/regclient/regclient/releases)\n"
         "and that it is available in the current working directory",
     )
+    parser.add_argument(
+        "--mirror-workers",
+        default=Mirror.workers,
+        type=int,
+        help="Number of parallel regsync workers used when mirroring.",
+    )
+    parser.add_argument(
+        "--regsync",
+        default=Mirror.regsync,
+        type=str,
+        help="Path to the regsync binary.",
+    )
+    parser.add_argument(
+        "--mirror-state",
+        default=Mirror.state,
+        type=Path,
+        help="File recording the source digests already mirrored,\n"
+        "so that only new or changed images are synced.",
+    )
+    parser.add_argument(
+        "--index-manifests",
+        action="store_true",
+        help="Also write an offset index of each manifest document per release,\n"
+        "allowing the charm to load only the resource kinds it needs.",
+    )
+    parser.add_argument(
+        "--pin-digests",
+        action="store_true",
+        help="Resolve each tagged image to the digest of its tag, recording it\n"
+        "in the release image inventory. The charm then references images\n"
+        "by digest, and pinned images are mirrored by digest.",
+    )
     parser.add_argument(
         "--sources",
         nargs="+",
@@ -299,9 +715,12 @@ if __name__ == "__main__":
     try:
         args = get_argparser().parse_args()
         registry = Registry(*args.registry) if args.registry else None
+        mirror = Mirror(args.mirror_workers, args.regsync, args.mirror_state)
         image_set = set()
         for source in args.sources:
-            version, source_images = main(source, registry)
+            version, source_images = main(
+                source, registry, mirror, args.index_manifests, args.pin_digests
+            )
             Path(FILEDIR, source, "version").write_text(f"{version}\n")
             print(f"source: {source} latest={version}")
             image_set |= source_images